@@ -0,0 +1,195 @@
+"""
+This script backfills the daily MLB data that scraper.py collects (team records, team schedules and box scores)
+over a range of dates, into a local SQLite database.
+
+Every table is keyed by date first (WITHOUT ROWID, so the rows of a day are stored together and a day is read or
+replaced as one range), and a day is only marked as fetched once everything for it came back. Reruns skip the
+days that are already marked, so an interrupted backfill picks up where it stopped, and extending the range only
+fetches the new days. Days from today on are stored but never marked, as they can still change.
+
+The days are fetched concurrently, with every MLB Stats API request going through one shared rate limiter.
+
+Usage:
+    python backfill.py -start 2019-03-28 -end 2019-09-29
+    python backfill.py -start 2019-03-28 -end 2019-09-29 -what box_scores -rate 5
+"""
+
+import time
+import sqlite3
+import datetime
+import argparse
+from datetime import timedelta
+
+from scraper import team_records, team_schedule, box_scores, RateLimiter, _run_concurrently
+
+KINDS = ('records', 'schedules', 'box_scores')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records(date TEXT, team TEXT, wins INTEGER, losses INTEGER,
+                                   PRIMARY KEY(date, team)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS schedules(date TEXT, slot TEXT, team TEXT,
+                                     PRIMARY KEY(date, slot)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS box_scores(date TEXT, game TEXT, home TEXT, away TEXT,
+                                      PRIMARY KEY(date, game)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS fetched(kind TEXT, date TEXT, fetched_at REAL,
+                                   PRIMARY KEY(kind, date)) WITHOUT ROWID;
+"""
+
+
+# Bumped whenever stored days turn out to be wrong and have to be fetched again
+STORE_VERSION = 1
+
+
+def open_store(db_name):
+    """ Opens (and creates, if need be) the backfill database
+    Args:
+        db_name: the database, str
+    Returns:
+        sqlite3.Connection
+    """
+    con = sqlite3.connect(db_name, isolation_level=None)
+    con.execute("""PRAGMA journal_mode=WAL""")
+    con.executescript(SCHEMA)
+
+    version = con.execute("""PRAGMA user_version""").fetchone()[0]
+
+    # Before version 1 the second game of a doubleheader overwrote the first, so every box score day is fetched
+    # again. Their rows are replaced as each day comes back in
+    if version < 1:
+        con.execute("""DELETE FROM fetched WHERE kind='box_scores'""")
+
+    con.execute(f"""PRAGMA user_version={STORE_VERSION}""")
+    return con
+
+
+def fetched_days(con, kind):
+    """ The days of a kind of data that are already stored for good
+    Args:
+        con: the backfill database, sqlite3.Connection
+        kind: one of KINDS, str
+    Returns:
+        {'YYYY-MM-DD'}, set
+    """
+    return set(row[0] for row in con.execute("""SELECT date FROM fetched WHERE kind=?""", (kind,)))
+
+
+def _fetch_day(kind, date, limiter, max_concurrency, timeout):
+    """ Fetches one day of one kind of data
+    Returns:
+        (rows, complete), where complete is False if part of the day could not be fetched
+    """
+    if kind == 'records':
+        limiter.wait()
+        records = team_records(date=date)[date]
+        return [(date, team, wins, losses) for team, (wins, losses) in records.items()], True
+
+    if kind == 'schedules':
+        limiter.wait()
+        schedule = team_schedule(date=date)[date]
+        return [(date, slot, team) for slot, team in schedule.items()], True
+
+    # Box scores fan out into two requests per game, which share the limiter with everything else
+    failed = []
+    scores = box_scores(date=date, max_concurrency=max_concurrency, timeout=timeout, limiter=limiter,
+                        failed=failed)[date]
+    return [(date, game, home, away) for game, (home, away) in scores.items()], not failed
+
+
+def _store_day(con, kind, date, rows, complete, today):
+    """ Replaces the stored rows of a day, and marks the day as fetched if it is complete and in the past """
+    columns = {'records': 4, 'schedules': 3, 'box_scores': 4}[kind]
+
+    con.execute("""BEGIN""")
+    try:
+        con.execute(f"""DELETE FROM {kind} WHERE date=?""", (date,))
+        con.executemany(f"""INSERT INTO {kind} VALUES({', '.join('?' * columns)})""", rows)
+
+        if complete and date < today:
+            con.execute("""INSERT OR REPLACE INTO fetched(kind, date, fetched_at) VALUES(?, ?, ?)""",
+                        (kind, date, time.time()))
+
+    except BaseException:
+        con.execute("""ROLLBACK""")
+        raise
+
+    con.execute("""COMMIT""")
+
+
+def backfill(start, end, db_name='mlb_history.db', kinds=KINDS, max_days=8, per_second=10., max_concurrency=8,
+             timeout=10., day_timeout=300.):
+    """ Backfills the records, schedules and box scores of every day from start to end (both included)
+    Args:
+        start: the first day, 'YYYY-MM-DD', str
+        end: the last day, 'YYYY-MM-DD', str
+        db_name: the backfill database, str
+        kinds: which of KINDS to backfill, tuple
+        max_days: the most days fetched at once, int
+        per_second: the most MLB Stats API requests started per second, across all days, numeric
+        max_concurrency: the most box score requests in flight at once, per day, int
+        timeout: how long a single box score request may take, in seconds, numeric
+        day_timeout: how long a whole day may take, in seconds, numeric
+    Returns:
+        {kind: {'fetched': int, 'skipped': int, 'incomplete': int, 'failed': int}}
+    """
+    first = datetime.datetime.strptime(start, '%Y-%m-%d')
+    last = datetime.datetime.strptime(end, '%Y-%m-%d')
+    assert first <= last, 'start must not be after end'
+
+    days = [(first + timedelta(days=i)).strftime('%Y-%m-%d') for i in range((last - first).days + 1)]
+    today = datetime.datetime.today().strftime('%Y-%m-%d')
+
+    con = open_store(db_name)
+    limiter = RateLimiter(per_second)
+    summary = {}
+
+    try:
+        for kind in kinds:
+            assert kind in KINDS, f'kind must be one of: {", ".join(KINDS)}'
+
+            done = fetched_days(con, kind)
+            todo = [day for day in days if day not in done]
+            summary[kind] = {'fetched': 0, 'skipped': len(days) - len(todo), 'incomplete': 0, 'failed': 0}
+
+            # Days are fetched a batch at a time and stored as soon as their batch is in, so that an interrupted
+            # backfill loses one batch at most
+            batch_size = max_days * 4
+            for i in range(0, len(todo), batch_size):
+                batch = todo[i:i + batch_size]
+                calls = [(_fetch_day, (kind, day, limiter, max_concurrency, timeout)) for day in batch]
+
+                for day, result in zip(batch, _run_concurrently(calls, max_days, day_timeout)):
+                    # A day that failed is not stored at all, and is tried again on the next run
+                    if result is None:
+                        summary[kind]['failed'] += 1
+                        continue
+
+                    rows, complete = result
+                    _store_day(con, kind, day, rows, complete, today)
+                    summary[kind]['fetched' if complete else 'incomplete'] += 1
+
+                print(f'{kind}: {min(i + batch_size, len(todo))}/{len(todo)} days')
+
+    finally:
+        con.close()
+
+    for kind, counts in summary.items():
+        print(f'{kind}: ' + ', '.join(f'{what}: {n}' for what, n in counts.items()))
+
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-start', type=str, required=True, help='the first day, YYYY-MM-DD')
+    parser.add_argument('-end', type=str, default=None, help='the last day, YYYY-MM-DD, yesterday by default')
+    parser.add_argument('-db', type=str, default='mlb_history.db', help='the backfill database')
+    parser.add_argument('-what', type=str, nargs='+', default=list(KINDS), help=f'any of: {", ".join(KINDS)}')
+    parser.add_argument('-days', type=int, default=8, help='the most days fetched at once')
+    parser.add_argument('-rate', type=float, default=10., help='the most requests per second')
+    parser.add_argument('-concurrency', type=int, default=8, help='the most box score requests at once, per day')
+    args = parser.parse_args()
+
+    end = args.end or (datetime.datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
+
+    backfill(args.start, end, db_name=args.db, kinds=tuple(args.what), max_days=args.days, per_second=args.rate,
+             max_concurrency=args.concurrency)
@@ -1,8 +1,13 @@
 from flask import Flask, session, render_template, url_for, request, redirect, jsonify
-from db_utils.db_connectors import user_query, increment_user_count
-from db_utils.admin import query_db
+from db_utils.db_connectors import user_query, increment_user_count, CountBuffer
+from db_utils.admin import setup_db
+from db_utils.leaderboard import Leaderboard, ORDERS
+from db_utils.work_queue import assign_images, complete_image, get_labels, release_images
 from file_utils.imgs import *
 import os
+import signal
+import sys
+import threading
 
 # pdf_folder = 'C:/Users/trevor_mcinroe/PycharmProjects/cortex/image_label_app/usr_holders'
 
@@ -13,6 +18,85 @@ app = Flask(__name__)
 IMAGES_FOLDER = os.path.join('static', 'images')
 app.config['images_folder'] = IMAGES_FOLDER
 
+# The full path to the same folder, where the images to label are read from
+app.config['raw_folder'] = r'C:\Users\trevor_mcinroe\PycharmProjects\cortex\image_label_app\static\images'
+
+# The SQLite database with the users, leases and labels
+app.config['db_name'] = 'core'
+
+# Batch the label count updates through a db_connectors.CountBuffer (made by init_app()) instead of writing
+# each one straight away
+app.config['write_behind'] = True
+app.config['count_buffer'] = None
+
+# The label counts for the admin table, cached between polls
+app.config['leaderboard'] = Leaderboard(db_name=app.config['db_name'])
+
+# How many images each annotator holds at once. The ones after the first are prefetched by the browser
+# so that the next image shows up as soon as a label is submitted
+IMAGES_PER_USER = 3
+
+_init_lock = threading.Lock()
+
+
+def init_app():
+    """Sets up everything that the routes need: the tables, the count buffer, the image index and the secret
+    key. Runs once, either from __main__ or on the first request, so that `python app.py`, `flask run` and
+    WSGI servers all get the same app. Anything that is already configured is left alone
+
+    Returns:
+
+    """
+
+    with _init_lock:
+        if app.config.get('initialized'):
+            return
+
+        setup_db(db_name=app.config['db_name'])
+
+        if app.config['write_behind'] and app.config['count_buffer'] is None:
+            app.config['count_buffer'] = CountBuffer(db_name=app.config['db_name'],
+                                                     on_flush=app.config['leaderboard'].invalidate)
+
+        # SIGTERM would otherwise end the process without running atexit, and so without the last flush of
+        # the counts. Turning it into a normal exit lets the CountBuffer write them. Signal handlers can only
+        # be set from the main thread, and WSGI servers that run us elsewhere handle SIGTERM themselves
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        # Building the image index up front, without the images that were labeled in earlier runs
+        get_index(raw_folder=app.config['raw_folder'],
+                  labeled=[row[0] for row in get_labels(db_name=app.config['db_name'])])
+
+        if not app.secret_key:
+            app.secret_key = os.urandom(12)
+
+        app.config['initialized'] = True
+
+
+@app.before_request
+def init_on_first_request():
+    if not app.config.get('initialized'):
+        init_app()
+
+
+def count_label(usr):
+    """Adds one to the count of images sorted by a user
+
+    Args:
+        usr: the username, str
+
+    Returns:
+
+    """
+
+    # With a CountBuffer, the leaderboard is invalidated when the buffer flushes instead
+    if app.config['count_buffer'] is None:
+        increment_user_count(db_name=app.config['db_name'], usr=usr)
+        app.config['leaderboard'].invalidate()
+    else:
+        app.config['count_buffer'].add(usr)
+
 
 @app.route('/', methods=['POST', 'GET'])
 def home():
@@ -33,7 +117,7 @@ def check_login():
     POSTED_PASSWORD = str(request.form['password'])
 
     # Making the
-    username, password_check = user_query(db_name='core', usr=POSTED_USERNAME, pswd=POSTED_PASSWORD)
+    username, password_check = user_query(db_name=app.config['db_name'], usr=POSTED_USERNAME, pswd=POSTED_PASSWORD)
 
     # If the password matches, send them to the dashboard
     # The username.split will grab the user's first name from the email 'first_last@domain.com'
@@ -51,6 +135,19 @@ def check_login():
         return redirect(url_for('home'))
 
 
+@app.route('/logout', methods=['POST', 'GET'])
+def logout():
+
+    # Handing the images that the user still holds back to the pool straight away, rather than after their
+    # leases expire
+    if session.get('logged_in'):
+        release_images(db_name=app.config['db_name'], usr=session['username'])
+
+    session.clear()
+
+    return redirect(url_for('home'))
+
+
 @app.route('/dashboard', methods=['POST', 'GET'])
 def dashboard():
     if not session.get('logged_in'):
@@ -59,26 +156,42 @@ def dashboard():
 
     else:
 
-        # The image that is being displayed
-        img = os.path.join('..',
-                           app.config['images_folder'],
-                           image_grab(raw_folder=r'C:\Users\trevor_mcinroe\PycharmProjects\cortex\image_label_app\static\images'))
-        print(img)
+        # Random unlabeled images, a few more than we need as some may be leased to other annotators
+        candidates = get_index(raw_folder=app.config['raw_folder']).random_images(4 * IMAGES_PER_USER)
+
+        # The images that this user, and only this user, should label next
+        images = assign_images(db_name=app.config['db_name'], usr=session['username'], candidates=candidates,
+                               n_images=IMAGES_PER_USER)
+
+        # Every image in the folder has been labeled, or is being labeled by someone else
+        if not images:
+            return 'There are no images left to label'
+
+        # The image that is being displayed, and the ones that come after it
+        img = os.path.join('..', app.config['images_folder'], images[0])
+        prefetch = [os.path.join('..', app.config['images_folder'], image) for image in images[1:]]
+
         return render_template('dashboard.html',
-                               image=img)
+                               image=img,
+                               prefetch=prefetch)
 
 
 @app.route('/logo-submit', methods=['POST', 'GET'])
 def l_submit():
 
-    image_sort(raw_folder=app.config['images_folder'],
-               image=os.path.join(r'C:\Users\trevor_mcinroe\PycharmProjects\cortex\image_label_app\static\images',
-                                  str(request.form['logo_path'])),
-               sorted_folder=r'C:\Users\trevor_mcinroe\PycharmProjects\cortex\image_label_app\static\images',
+    # Recording the label. Only the first label of an image counts, i.e. a double click or a
+    # resubmitted form does nothing
+    if not complete_image(db_name=app.config['db_name'], usr=session['username'],
+                          image=image_name(str(request.form['logo_path'])),
+                          label='logo'):
+        return redirect(url_for('dashboard'))
+
+    image_sort(raw_folder=app.config['raw_folder'],
+               image=str(request.form['logo_path']),
                selection='logo')
 
     # Updating the count of images sorted by the user in the session
-    increment_user_count(db_name='core', usr=session['username'])
+    count_label(usr=session['username'])
 
     return redirect(url_for('dashboard'))
 
@@ -86,14 +199,19 @@ def l_submit():
 @app.route('/no-logo-submit', methods=['POST', 'GET'])
 def nl_submit():
 
-    image_sort(raw_folder=app.config['images_folder'],
-               image=os.path.join(r'C:\Users\trevor_mcinroe\PycharmProjects\cortex\image_label_app\static\images',
-                                  str(request.form['nlogo_path'])),
-               sorted_folder=r'C:\Users\trevor_mcinroe\PycharmProjects\cortex\image_label_app\static\images',
+    # Recording the label. Only the first label of an image counts, i.e. a double click or a
+    # resubmitted form does nothing
+    if not complete_image(db_name=app.config['db_name'], usr=session['username'],
+                          image=image_name(str(request.form['nlogo_path'])),
+                          label='no_logo'):
+        return redirect(url_for('dashboard'))
+
+    image_sort(raw_folder=app.config['raw_folder'],
+               image=str(request.form['nlogo_path']),
                selection='no_logo')
 
     # Updating the count of images sorted by the user in the session
-    increment_user_count(db_name='core', usr=session['username'])
+    count_label(usr=session['username'])
 
     return redirect(url_for('dashboard'))
 
@@ -102,19 +220,23 @@ def nl_submit():
 @app.route('/getting_data', methods=['POST', 'GET'])
 def mhmm():
 
-    all_results = query_db(db_name='core')
+    # Optional paging and ordering, i.e. /getting_data?offset=50&limit=50&order=count
+    # Without them every user is returned, highest count first
+    offset = request.args.get('offset', default=0, type=int)
+    limit = request.args.get('limit', default=None, type=int)
+    order = request.args.get('order', default='count', type=str)
+
+    if offset < 0 or (limit is not None and limit < 0) or order not in ORDERS:
+        return jsonify({'error': f'offset and limit must be positive, order one of: {", ".join(ORDERS)}'}), 400
 
-    data = [
-        {
-            'username': usr[1],
-            'count': usr[4]
-        }
-        for usr in all_results
-    ]
+    data, etag = app.config['leaderboard'].page(offset=offset, limit=limit, order=order)
 
-    data = {'data': data}
+    # The browser has to check back on every poll, but when nothing changed it gets an empty 304
+    response = jsonify(data)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
 
-    return jsonify(data)
+    return response.make_conditional(request)
 
 
 @app.route('/administrative', methods=['POST', 'GET'])
@@ -134,5 +256,5 @@ def mhmm2():
             return render_template('test_table.html')
 
 if __name__ == '__main__':
-    app.secret_key = os.urandom(12)
+    init_app()
     app.run()
@@ -1,6 +1,7 @@
-import sqlite3
 from passlib.hash import bcrypt
 
+from db_utils.database import transaction, query
+
 def create_user_db(db_name):
     """
 
@@ -11,23 +12,96 @@ def create_user_db(db_name):
 
     """
 
-    # Making a connection to the database
-    # If it does not yet exist, SQLite will create it
-    con = sqlite3.connect(database=db_name)
+    # The pooled connection creates the database if it does not yet exist, and the table is
+    # committed at the end of the with block
+    with transaction(db_name) as con:
+        con.execute("""
+            CREATE TABLE users(id INTEGER PRIMARY KEY,
+                                username TEXT,
+                                password TEXT,
+                                name TEXT,
+                                count INTEGER
+            )""")
+
+    create_user_index(db_name)
+
+
+def create_user_index(db_name):
+    """Indexes users by username, which is how every login and every count update looks them up. Safe to
+    call on every start up, as it does nothing if the index is already there
+
+    Args:
+        db_name:
+
+    Returns:
+
+    """
+
+    with transaction(db_name) as con:
+        con.execute("""CREATE INDEX IF NOT EXISTS users_username ON users(username)""")
+
+
+def create_lease_table(db_name):
+    """Creates the table that work_queue.py uses to hand images out to annotators. Safe to call on
+    every start up, as it does nothing if the table is already there
+
+    Args:
+        db_name:
+
+    Returns:
+
+    """
+
+    with transaction(db_name) as con:
+
+        # One row per image that was ever handed out. done=1 once it has been labeled
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS leases(image TEXT PRIMARY KEY,
+                                              username TEXT NOT NULL,
+                                              leased_at REAL NOT NULL,
+                                              expires REAL NOT NULL,
+                                              done INTEGER NOT NULL DEFAULT 0
+            )""")
+
+        # For looking up the open leases of a user
+        con.execute("""CREATE INDEX IF NOT EXISTS leases_username ON leases(username, done)""")
 
-    # Creating our cursor object and then using it to execute the creation of the table
-    cursor = con.cursor()
-    cursor.execute("""
-        CREATE TABLE users(id INTEGER PRIMARY KEY,
-                            username TEXT,
-                            password TEXT,
-                            name TEXT,
-                            count INTEGER
-        )""")
 
-    # Committing and then closing the connection. Because, best practices and stuff
-    con.commit()
-    cursor.close()
+def create_label_table(db_name):
+    """Creates the table that holds the labels themselves, one row per labeled image. Safe to call on
+    every start up, as it does nothing if the table is already there
+
+    Args:
+        db_name:
+
+    Returns:
+
+    """
+
+    # The images themselves stay where they are, export_labels.py turns these rows into a dataset
+    with transaction(db_name) as con:
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS labels(image TEXT PRIMARY KEY,
+                                              label TEXT NOT NULL,
+                                              username TEXT NOT NULL,
+                                              labeled_at REAL NOT NULL
+            )""")
+
+
+def setup_db(db_name):
+    """Brings an existing users database up to date with everything that the app needs, on start up
+
+    Args:
+        db_name:
+
+    Returns:
+
+    """
+
+    create_user_index(db_name)
+    create_lease_table(db_name)
+    create_label_table(db_name)
+
 
 def create_user(db_name, usr, pswd, name, count=0):
     """
@@ -42,18 +116,10 @@ def create_user(db_name, usr, pswd, name, count=0):
 
     """
 
-    # Making a connection to the database
-    # If it does not yet exist, SQLite will create it
-    con = sqlite3.connect(database=db_name)
-
-    # Creating our cursor object and then using it to execute the creation of the table
-    cursor = con.cursor()
-    cursor.execute("""INSERT INTO users(username, password, name, count) VALUES(?, ?, ?, ?)""",
-                   (usr, bcrypt.hash(pswd), name, count))
-
     # You already know
-    con.commit()
-    cursor.close()
+    with transaction(db_name) as con:
+        con.execute("""INSERT INTO users(username, password, name, count) VALUES(?, ?, ?, ?)""",
+                    (usr, bcrypt.hash(pswd), name, count))
 
 
 def query_db(db_name):
@@ -66,17 +132,9 @@ def query_db(db_name):
 
     """
 
-    # Making a connection to the database
-    # If it does not yet exist, SQLite will create it
-    con = sqlite3.connect(database=db_name)
-
-    # Creating our cursor object and then using it to execute the creation of the table
-    cursor = con.cursor()
-    cursor.execute("""SELECT * FROM users""")
-
-    return cursor.fetchall()
+    return query(db_name, """SELECT * FROM users""")
 
-print(query_db(db_name='core'))
+# print(query_db(db_name='core'))
 # create_user_db(db_name='core')
 # create_user(db_name='core',
 #             usr='trevor_mcinroe@quadraticinsights.com',
@@ -0,0 +1,155 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# How long a statement waits on another connection's write lock before giving up, in seconds
+BUSY_TIMEOUT = 10
+
+# The most idle connections kept open per database. Busier moments open extra connections, which are
+# closed again when they are given back
+MAX_IDLE_CONNECTIONS = 16
+
+# sqlite3 keeps the compiled form of the last N statements of every connection. Our queries are module
+# level constants, so with connections that live on they only ever get prepared once
+CACHED_STATEMENTS = 256
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _open(db_name):
+    """Opens a connection, set up for many concurrent readers and writers
+
+    Args:
+        db_name: the database, str
+
+    Returns:
+        sqlite3.Connection
+    """
+
+    # isolation_level=None leaves the transactions to us (see transaction()). A connection is only ever
+    # used by one thread at a time, but it can be a different thread each time it leaves the pool
+    con = sqlite3.connect(database=db_name, timeout=BUSY_TIMEOUT, isolation_level=None,
+                          cached_statements=CACHED_STATEMENTS, check_same_thread=False)
+
+    # With write-ahead logging, readers never block the writer and the writer never blocks readers. The
+    # setting is stored in the database file itself, so this only does anything the first time
+    con.execute("""PRAGMA journal_mode=WAL""")
+
+    # In WAL mode this is still safe against corruption, it only skips the fsync() on every commit
+    con.execute("""PRAGMA synchronous=NORMAL""")
+
+    return con
+
+
+def _pool(db_name):
+    with _pools_lock:
+        if db_name not in _pools:
+            _pools[db_name] = queue.LifoQueue()
+        return _pools[db_name]
+
+
+@contextmanager
+def connection(db_name):
+    """Borrows a connection from the pool of a database, for the length of a with block
+
+    Args:
+        db_name: the database, str
+
+    Returns:
+        yields sqlite3.Connection
+    """
+
+    pool = _pool(db_name)
+
+    # LIFO, so that the connections that were used most recently (and have warm caches) go out first
+    try:
+        con = pool.get_nowait()
+    except queue.Empty:
+        con = _open(db_name)
+
+    try:
+        yield con
+
+    finally:
+        # Never hand the next borrower a half finished transaction
+        if con.in_transaction:
+            con.rollback()
+
+        if pool.qsize() < MAX_IDLE_CONNECTIONS:
+            pool.put(con)
+        else:
+            con.close()
+
+
+@contextmanager
+def transaction(db_name):
+    """Runs the statements of a with block as a single transaction, committed at the end of the block or
+    rolled back if it raises. The write lock is taken up front (BEGIN IMMEDIATE), so two transactions
+    can never read the same row and then both write it
+
+    Args:
+        db_name: the database, str
+
+    Returns:
+        yields sqlite3.Connection
+    """
+
+    with connection(db_name) as con:
+        con.execute("""BEGIN IMMEDIATE""")
+
+        try:
+            yield con
+
+        except BaseException:
+            con.execute("""ROLLBACK""")
+            raise
+
+        con.execute("""COMMIT""")
+
+
+def query(db_name, sql, params=()):
+    """Runs a SELECT on a pooled connection
+
+    Args:
+        db_name: the database, str
+        sql: the statement, str
+        params: the values of its ? placeholders, tuple
+
+    Returns:
+        the rows, list of tuple
+    """
+
+    with connection(db_name) as con:
+        return con.execute(sql, params).fetchall()
+
+
+def execute(db_name, sql, params=()):
+    """Runs a single statement on a pooled connection, which SQLite commits as soon as it is done
+
+    Args:
+        db_name: the database, str
+        sql: the statement, str
+        params: the values of its ? placeholders, tuple
+
+    Returns:
+        the number of rows that were changed, int
+    """
+
+    with connection(db_name) as con:
+        return con.execute(sql, params).rowcount
+
+
+def close_all():
+    """Closes every idle connection, i.e. on shutdown or before the database file is moved"""
+
+    with _pools_lock:
+        pools = list(_pools.values())
+
+    for pool in pools:
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
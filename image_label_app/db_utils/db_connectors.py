@@ -1,6 +1,11 @@
-import sqlite3
+import atexit
+import threading
+import traceback
+from collections import defaultdict
 from passlib.hash import bcrypt
 
+from db_utils.database import transaction, query, execute
+
 def user_query(db_name, usr, pswd):
     """
 
@@ -14,21 +19,12 @@ def user_query(db_name, usr, pswd):
 
     """
 
-    # Making a connection to the database
-    # If it does not yet exist, SQLite will create it
-    con = sqlite3.connect(database=db_name)
-
-    # Creating our cursor object and then using it to execute the creation of the table
-    cursor = con.cursor()
-
-    # Querying the database and then using the fetchall() method to return the data
-    cursor.execute("""SELECT username, password, name FROM users WHERE username=?""",
-                   (usr,))
-    result = cursor.fetchall()
+    # Querying the database over a pooled connection, the lookup goes through the users_username index
+    result = query(db_name, """SELECT username, password, name FROM users WHERE username=?""", (usr,))
 
     # Catch for when nothing is returned
     if len(result) == 0:
-        return False, False, False
+        return False, False
 
     # If a user was successfully returned, we need to make sure that the password matches
     # Thankfully, bcrypt has a nice convenience function that returns a BOOL
@@ -46,25 +42,125 @@ def increment_user_count(db_name, usr, increment=1):
     Returns:
 
     """
-    # Making a connection to the database
-    # If it does not yet exist, SQLite will create it
-    con = sqlite3.connect(database=db_name)
-
-    # Creating our cursor object which manages our connection to the db
-    cursor = con.cursor()
-
-    # Querying the database and then using the fetchall() method to return the data
-    # The data returns as a list of tuples [(count,)]
-    cursor.execute("""SELECT count FROM users WHERE username=?""",
-                   (usr,))
-    result = cursor.fetchall()[0][0]
-
-    # Now adding our increment to the result
-    new_count = result + increment
-
-    # Updating the count value using our cursor
-    # It is necessary to explicitly commit() our changes
-    cursor.execute("""UPDATE users SET count=? where username=?""",
-                   (new_count, usr,))
-    con.commit()
-    cursor.close()
+    # A single statement does the read and the write, so it is atomic (no lost increments when two
+    # submits land at the same time) and only one round trip
+    execute(db_name, """UPDATE users SET count = count + ? WHERE username=?""", (increment, usr))
+
+
+class CountBuffer:
+    """A write-behind buffer for the label counts of the users. Increments are added up per user in memory
+    and written in a single transaction every flush_every increments or every flush_interval seconds,
+    whichever comes first, so a burst of submits costs one write instead of one each.
+
+    The buffer is flushed one last time when it is closed, which also happens when the interpreter exits.
+    A hard kill of the process loses at most the last flush_interval seconds of counts (the labels
+    themselves are written straight away, so the counts can always be recovered from those).
+
+    Args:
+        db_name: the database, str
+        flush_every: flush after this many increments, int
+        flush_interval: flush at least this often, in seconds, numeric
+        on_flush: called with the {username: increment} that were just written, function
+    """
+
+    def __init__(self, db_name, flush_every=50, flush_interval=.5, on_flush=None):
+        self.db_name = db_name
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+
+        self._pending = defaultdict(int)
+        self._n_pending = 0
+        self._lock = threading.Lock()
+
+        # Only one flush writes at a time, so that they land in order
+        self._flush_lock = threading.Lock()
+
+        # Set by add() when the buffer is full, so that the flusher thread writes early. The request thread
+        # never writes itself, so a busy database can not turn a label that was recorded into an error
+        self._wake = threading.Event()
+
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+        atexit.register(self.close)
+
+    def add(self, usr, increment=1):
+        """Adds to the count of a user
+
+        Args:
+            usr: the username, str
+            increment: how much to add, int
+        """
+
+        with self._lock:
+            self._pending[usr] += increment
+            self._n_pending += 1
+            full = self._n_pending >= self.flush_every
+
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """Writes every pending increment in one transaction
+
+        Returns:
+            the number of users whose counts were written, int
+        """
+
+        with self._flush_lock:
+
+            # Swapping the pending counts out, so that submits can keep adding while we write
+            with self._lock:
+                pending, self._pending = self._pending, defaultdict(int)
+                self._n_pending = 0
+
+            if not pending:
+                return 0
+
+            try:
+                with transaction(self.db_name) as con:
+                    con.executemany("""UPDATE users SET count = count + ? WHERE username=?""",
+                                    [(increment, usr) for usr, increment in pending.items()])
+
+            # Putting the counts back, so that the next flush tries them again instead of losing them
+            except Exception:
+                with self._lock:
+                    for usr, increment in pending.items():
+                        self._pending[usr] += increment
+                    self._n_pending += len(pending)
+                raise
+
+        if self.on_flush is not None:
+            self.on_flush(dict(pending))
+
+        return len(pending)
+
+    def _flush_periodically(self):
+        while not self._closed.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+
+            # close() does the last flush itself
+            if self._closed.is_set():
+                break
+
+            try:
+                self.flush()
+            except Exception:
+                # The database was busy or gone, the counts are still pending and the next tick retries
+                traceback.print_exc()
+
+    def close(self):
+        """Stops the periodic flushes and writes whatever is still pending"""
+
+        if self._closed.is_set():
+            return
+
+        self._closed.set()
+        self._wake.set()
+        self._flusher.join()
+        self.flush()
+
+        atexit.unregister(self.close)
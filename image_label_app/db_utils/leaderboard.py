@@ -0,0 +1,105 @@
+import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from db_utils.database import query
+
+# The columns that the leaderboard can be sorted by, and the ORDER BY that goes with each
+ORDERS = {
+    'count': """count DESC, username""",
+    'username': """username""",
+}
+
+# The most pages kept in the cache. The pages come from the query string of the clients, so without a cap a
+# client walking through offsets could grow the cache without end between two invalidations
+MAX_CACHED_PAGES = 256
+
+
+class Leaderboard:
+    """The label counts of the users, as served to the admin table, cached for a few seconds.
+
+    The admin page polls for these, and between two polls the counts have usually not changed, so a page
+    of the leaderboard is only read from the database when it is older than ttl seconds or when
+    .invalidate() was called because a count changed. Every page also gets an ETag, so a client that
+    already has the current version gets an empty 304 instead of the same JSON again.
+
+    Args:
+        db_name: the database, str
+        ttl: how long a page is served from the cache, in seconds, numeric
+        max_pages: the most pages to cache, the least recently used ones are dropped first, int
+    """
+
+    def __init__(self, db_name, ttl=2., max_pages=MAX_CACHED_PAGES):
+        self.db_name = db_name
+        self.ttl = ttl
+        self.max_pages = max_pages
+
+        # Least recently used first
+        self._cache = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _read(self, offset, limit, order):
+        """Reads a page of the leaderboard from the database, with only the columns that it shows"""
+
+        rows = query(self.db_name,
+                     f"""SELECT username, count FROM users ORDER BY {ORDERS[order]} LIMIT ? OFFSET ?""",
+                     (-1 if limit is None else limit, offset))
+        total = query(self.db_name, """SELECT COUNT(*) FROM users""")[0][0]
+
+        return {'data': [{'username': username, 'count': count} for username, count in rows],
+                'total': total,
+                'offset': offset}
+
+    def page(self, offset=0, limit=None, order='count'):
+        """A page of the leaderboard
+
+        Args:
+            offset: the number of users to skip, int
+            limit: the number of users to return, all of them if None, int
+            order: 'count' (highest first) or 'username', str
+
+        Returns:
+            ({'data': [{'username': str, 'count': int}], 'total': int, 'offset': int}, ETag), (dict, str)
+        """
+
+        assert order in ORDERS, f'order must be one of: {", ".join(ORDERS)}'
+
+        key = (offset, limit, order)
+        now = time.monotonic()
+
+        with self._lock:
+            cached = self._cache.get(key)
+            generation = self._generation
+
+            if cached is not None:
+                self._cache.move_to_end(key)
+
+        if cached is not None and cached[0] > now:
+            return cached[1], cached[2]
+
+        payload = self._read(offset, limit, order)
+
+        # The ETag comes from the content, so a page that was read again but did not change keeps its ETag
+        etag = hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+        # A count that changed while we were reading makes this page stale already, so it is not cached
+        with self._lock:
+            if generation == self._generation:
+                self._cache[key] = (now + self.ttl, payload, etag)
+                self._cache.move_to_end(key)
+
+                while len(self._cache) > self.max_pages:
+                    self._cache.popitem(last=False)
+
+        return payload, etag
+
+    def invalidate(self, *args):
+        """Drops every cached page, i.e. after a count changed. Takes (and ignores) any arguments, so that
+        it can be used as the on_flush callback of a CountBuffer"""
+
+        with self._lock:
+            self._cache.clear()
+            self._generation += 1
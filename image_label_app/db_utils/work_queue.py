@@ -0,0 +1,119 @@
+import time
+
+from db_utils.database import transaction, query, execute
+
+# How long an image stays assigned to a user before it goes back in the pool, in seconds
+LEASE_SECONDS = 300
+
+
+def assign_images(db_name, usr, candidates, n_images=3, lease_seconds=LEASE_SECONDS):
+    """Hands a user the images that they should label next, leasing each one to them so that nobody
+    else is shown it. A user keeps (and renews) the leases that they already hold, and gets new ones
+    from the candidates until they hold n_images. The first image is the one to show, the rest are
+    there so that the page can prefetch them.
+
+    Leases that are not completed within lease_seconds, i.e. from an annotator that closed the tab,
+    expire and the image can be leased to someone else.
+
+    Args:
+        db_name: the database, str
+        usr: the username, str
+        candidates: unlabeled images to lease from, in order of preference, list of str
+        n_images: how many images a user holds at once, int
+        lease_seconds: how long a lease lasts, numeric
+
+    Returns:
+        the images leased to the user, oldest first, list of str
+    """
+
+    now = time.time()
+    expires = now + lease_seconds
+
+    # Everything below happens under the write lock, so two annotators can never claim the same image
+    with transaction(db_name) as con:
+        cursor = con.cursor()
+
+        # Renewing the leases that the user still holds
+        cursor.execute("""UPDATE leases SET expires=? WHERE username=? AND done=0 AND expires>=?""",
+                       (expires, usr, now))
+
+        cursor.execute("""SELECT image FROM leases WHERE username=? AND done=0 AND expires>=?
+                          ORDER BY leased_at, image""",
+                       (usr, now))
+        leased = [row[0] for row in cursor.fetchall()]
+
+        for image in candidates:
+            if len(leased) >= n_images:
+                break
+
+            if image in leased:
+                continue
+
+            # Claiming the image if it was never leased, or if its lease expired without a label
+            cursor.execute("""INSERT INTO leases(image, username, leased_at, expires) VALUES(?, ?, ?, ?)
+                              ON CONFLICT(image) DO UPDATE
+                              SET username=excluded.username, leased_at=excluded.leased_at, expires=excluded.expires
+                              WHERE leases.done=0 AND leases.expires<?""",
+                           (image, usr, now, expires, now))
+
+            if cursor.rowcount == 1:
+                leased.append(image)
+
+    return leased
+
+
+def complete_image(db_name, usr, image, label):
+    """Records the label of an image and closes its lease. An expired lease still counts, as long as
+    nobody else labeled the image in the meantime
+
+    Args:
+        db_name: the database, str
+        usr: the username, str
+        image: the filename of the image, str
+        label: the class that the user picked, str
+
+    Returns:
+        True if this is the first label of the image, False if it was already labeled, bool
+    """
+
+    now = time.time()
+
+    with transaction(db_name) as con:
+        cursor = con.cursor()
+
+        # Closing the lease is the check that nobody labeled the image before us
+        cursor.execute("""INSERT INTO leases(image, username, leased_at, expires, done) VALUES(?, ?, ?, ?, 1)
+                          ON CONFLICT(image) DO UPDATE SET username=excluded.username, done=1
+                          WHERE leases.done=0""",
+                       (image, usr, now, now))
+        first = cursor.rowcount == 1
+
+        if first:
+            cursor.execute("""INSERT INTO labels(image, label, username, labeled_at) VALUES(?, ?, ?, ?)""",
+                           (image, label, usr, now))
+
+    return first
+
+
+def get_labels(db_name):
+    """Every label that has been recorded
+
+    Args:
+        db_name: the database, str
+
+    Returns:
+        [(image, label, username, labeled_at)], list of tuple
+    """
+
+    return query(db_name, """SELECT image, label, username, labeled_at FROM labels ORDER BY labeled_at""")
+
+
+def release_images(db_name, usr):
+    """Gives back every image that a user holds but has not labeled, i.e. when they log out
+
+    Args:
+        db_name: the database, str
+        usr: the username, str
+    """
+
+    execute(db_name, """DELETE FROM leases WHERE username=? AND done=0""", (usr,))
@@ -0,0 +1,140 @@
+"""
+This script turns the labels that the app records in the database into a dataset, in bulk.
+
+The app never copies an image when it is labeled, a label is just a row in the labels table. This is
+where those rows become something that training can read, either:
+    class folders: <out>/logo/..., <out>/no_logo/..., filled with hardlinks (or symlinks) to the raw
+                   images, so no image data is duplicated
+    TFRecords: sharded .tfrecord files written straight from the raw images, with the labels taken
+               from the database
+
+Usage:
+    python export_labels.py -out //server/data/logos
+    python export_labels.py -tfrecord //server/data/logos/train -shards 16
+"""
+
+import os
+import sys
+import json
+import argparse
+from shutil import copy2
+
+from db_utils.work_queue import get_labels
+from file_utils.imgs import LABELS
+
+
+def materialize(labels, raw_folder, out_folder, mode='hardlink'):
+    """Builds one folder per class, holding links to (or copies of) the labeled images
+
+    Args:
+        labels: [(image, label, ...)], i.e. the output of get_labels(), list of tuple
+        raw_folder: the folder that the images were labeled in, str
+        out_folder: the class folders are created in here, str
+        mode: 'hardlink', 'symlink' or 'copy'. Hardlinks fall back to copies across drives, str
+
+    Returns:
+        {'linked': int, 'copied': int, 'skipped': int, 'missing': int}, dict
+    """
+
+    assert mode in ('hardlink', 'symlink', 'copy'), 'mode must be one of: hardlink, symlink, copy'
+    assert os.path.isdir(raw_folder), 'raw_folder does not exist'
+
+    counts = {'linked': 0, 'copied': 0, 'skipped': 0, 'missing': 0}
+
+    for label in set(row[1] for row in labels):
+        os.makedirs(os.path.join(out_folder, label), exist_ok=True)
+
+    for image, label, *_ in labels:
+        src = os.path.join(raw_folder, image)
+        dst = os.path.join(out_folder, label, image)
+
+        # Anything that is already there came from an earlier export, so reruns only add the new labels
+        if os.path.lexists(dst):
+            counts['skipped'] += 1
+            continue
+
+        if not os.path.isfile(src):
+            counts['missing'] += 1
+            continue
+
+        try:
+            if mode == 'hardlink':
+                os.link(src, dst)
+            elif mode == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+            else:
+                copy2(src, dst)
+                counts['copied'] += 1
+                continue
+
+            counts['linked'] += 1
+
+        # Hardlinks cannot cross drives (and symlinks need extra privileges on Windows)
+        except OSError:
+            copy2(src, dst)
+            counts['copied'] += 1
+
+    return counts
+
+
+def export_tfrecords(labels, raw_folder, tfrecord_prefix, n_shards=16, n_workers=None, seed=None):
+    """Streams the labeled images straight into sharded TFRecords, without any class folders in between
+
+    Args:
+        labels: [(image, label, ...)], i.e. the output of get_labels(), list of tuple
+        raw_folder: the folder that the images were labeled in, str
+        tfrecord_prefix: the shards are written to <tfrecord_prefix>-00000-of-00016 and so on, str
+        n_shards: the number of shards to write, int
+        n_workers: the number of processes to write with, defaults to the number of cores, int
+        seed: seeds the shuffle of the images within each shard, int
+
+    Returns:
+        a list of the full paths to the shards
+    """
+
+    # The TFRecord writers live with the rest of the dataset tooling in utils/
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+    from tfrecord_creation import tfrecord_generator
+
+    # The ids follow the order of LABELS, so they do not change with which classes happen to be labeled
+    class_names_to_ids = {label: i for i, label in enumerate(LABELS)}
+
+    # Writing the labels dictionary next to the shards, same as prepare_dataset() does
+    with open(tfrecord_prefix + '.labels.txt', 'w') as f:
+        f.write(json.dumps(class_names_to_ids))
+
+    generator = tfrecord_generator(labels=class_names_to_ids)
+
+    return generator.convert_labeled_images_sharded(img_folder=raw_folder,
+                                                    img_labels={image: label for image, label, *_ in labels},
+                                                    tfrecord_prefix=tfrecord_prefix,
+                                                    n_shards=n_shards,
+                                                    n_workers=n_workers,
+                                                    seed=seed)
+
+
+# The TFRecord workers re-import this module on Windows, so the driver has to live under the __main__ guard
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-db', type=str, default='core', help='the database of the app')
+    parser.add_argument('-raw', type=str, default=os.path.join('static', 'images'),
+                        help='the folder that the images were labeled in')
+    parser.add_argument('-out', type=str, default=None, help='build class folders in this folder')
+    parser.add_argument('-mode', type=str, default='hardlink', help='hardlink, symlink or copy')
+    parser.add_argument('-tfrecord', type=str, default=None, help='write TFRecord shards with this prefix')
+    parser.add_argument('-shards', type=int, default=16, help='the number of TFRecord shards')
+    parser.add_argument('-seed', type=int, default=None, help='seeds the shuffle within the shards')
+    args = parser.parse_args()
+
+    assert args.out or args.tfrecord, 'nothing to do, pass -out and/or -tfrecord'
+
+    labels = get_labels(db_name=args.db)
+    print(f'{len(labels)} labeled images in {args.db}')
+
+    if args.out:
+        counts = materialize(labels, raw_folder=args.raw, out_folder=args.out, mode=args.mode)
+        print(', '.join(f'{what}: {n}' for what, n in counts.items()))
+
+    if args.tfrecord:
+        export_tfrecords(labels, raw_folder=args.raw, tfrecord_prefix=args.tfrecord, n_shards=args.shards,
+                         seed=args.seed)
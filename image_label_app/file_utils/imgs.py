@@ -1,61 +1,250 @@
 import os
 import random
-from shutil import copy2
+import threading
+import time
 
 
-def image_grab(raw_folder):
+# The file extensions that count as images
+IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png')
+
+# The classes that an image can be sorted into
+LABELS = ('logo', 'no_logo')
+
+
+class ImageIndex:
+    """An in-memory index of the unlabeled images in a folder, so that picking one is O(1) instead of a
+    listing of the whole folder.
+
+    The folder is scanned once with os.scandir(), keeping only files with an image extension. Images
+    that were already labeled, or that sit in one of the sorted folders from before labels were kept in
+    the database, are left out, and image_sort() tells the index about every new label, so an image is
+    never handed out again once it has been labeled.
+
+    New frames get dropped into the raw folder while the app is running. Adding or removing a file
+    changes the mtime of the folder, so the index checks that (at most every refresh_interval seconds)
+    and only rescans when it has changed.
+
+    Args:
+        raw_folder: the folder of images to label, str
+        labeled: the filenames of the images that were already labeled, iterable of str
+        labeled_folders: the folders that hold images that were already labeled. Defaults to every
+                         subfolder of raw_folder, which is where the app used to sort images to, list
+        refresh_interval: the minimum number of seconds between mtime checks, numeric
     """
 
+    def __init__(self, raw_folder, labeled=(), labeled_folders=None, refresh_interval=5.):
+
+        assert os.path.isdir(raw_folder), 'raw_folder does not exist'
+
+        self.raw_folder = raw_folder
+        self.labeled_folders = labeled_folders
+        self.refresh_interval = refresh_interval
+
+        # The unlabeled images live in a list, for O(1) random picks, and a {name: position in the list}
+        # dict, for O(1) removal by swapping with the last element
+        self._images = []
+        self._positions = {}
+        self._labeled = set(labeled)
+
+        self._mtime = None
+        self._last_check = 0.
+        self._lock = threading.Lock()
+
+        self._scan_labeled()
+        self._scan()
+
+    def _labeled_folders(self):
+        if self.labeled_folders is not None:
+            return self.labeled_folders
+
+        with os.scandir(self.raw_folder) as entries:
+            return [entry.path for entry in entries if entry.is_dir()]
+
+    def _scan_labeled(self):
+        """Collects the names of the images in the labeled folders"""
+
+        for folder in self._labeled_folders():
+            if not os.path.isdir(folder):
+                continue
+
+            with os.scandir(folder) as entries:
+                self._labeled.update(entry.name for entry in entries if entry.is_file())
+
+    def _scan(self):
+        """(Re)builds the index from a single os.scandir() of the raw folder"""
+
+        self._mtime = os.stat(self.raw_folder).st_mtime_ns
+
+        # Splitting on the last '.' is agnostic to the number of '.' in a filename
+        with os.scandir(self.raw_folder) as entries:
+            found = {entry.name for entry in entries
+                     if entry.name.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS and entry.is_file()}
+
+        found -= self._labeled
+
+        # Dropping the images that were deleted and then adding the new ones, so the positions of the
+        # images that stayed do not have to be rebuilt
+        for name in set(self._positions) - found:
+            self._remove(name)
+
+        for name in found - set(self._positions):
+            self._positions[name] = len(self._images)
+            self._images.append(name)
+
+    def _remove(self, name):
+        position = self._positions.pop(name, None)
+        if position is None:
+            return
+
+        last = self._images.pop()
+        if position < len(self._images):
+            self._images[position] = last
+            self._positions[last] = position
+
+    def refresh(self, force=False):
+        """Rescans the raw folder if its mtime changed since the last scan
+
+        Args:
+            force: check the mtime even if the last check was less than refresh_interval seconds ago, bool
+
+        Returns:
+            whether or not a rescan happened, bool
+        """
+
+        now = time.monotonic()
+
+        with self._lock:
+            if not force and now - self._last_check < self.refresh_interval:
+                return False
+
+            self._last_check = now
+
+            if os.stat(self.raw_folder).st_mtime_ns == self._mtime:
+                return False
+
+            self._scan()
+            return True
+
+    def random_image(self):
+        """Picks a random unlabeled image
+
+        Returns:
+            the filename of the image, or None when everything has been labeled, str
+        """
+
+        self.refresh()
+
+        with self._lock:
+            if not self._images:
+                return None
+
+            return self._images[random.randrange(len(self._images))]
+
+    def random_images(self, k):
+        """Picks up to k different random unlabeled images
+
+        Args:
+            k: the number of images, int
+
+        Returns:
+            the filenames of the images, list of str
+        """
+
+        self.refresh()
+
+        with self._lock:
+            return random.sample(self._images, min(k, len(self._images)))
+
+    def mark_labeled(self, name):
+        """Takes an image out of the index for good
+
+        Args:
+            name: the filename of the image, str
+        """
+
+        with self._lock:
+            self._labeled.add(name)
+            self._remove(name)
+
+    def __len__(self):
+        return len(self._images)
+
+
+# One index per raw folder, shared by every request that the app serves
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(raw_folder, labeled=()):
+    """Returns the ImageIndex of a folder, building it on first use
+
     Args:
-        raw_folder:
+        raw_folder: the folder of images to label, str
+        labeled: the filenames of the images that were already labeled, only used when the index is
+                 built, iterable of str
 
     Returns:
-
+        ImageIndex
     """
 
-    # Assert that there are images in raw folder and that the sorted folders exist
-    assert os.path.isdir(raw_folder), 'raw_folder does not exist'
+    # The app refers to the same folder with both relative and absolute paths
+    key = os.path.normcase(os.path.realpath(raw_folder))
 
-    # If the raw_folder that we point at contains non-images, we need to filter those out
-    # As far as I have tested, the fastest way to do this is with a WHILE block
-    # that uses the file extension as the break condition
-    break_condition = ' '
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = ImageIndex(raw_folder, labeled=labeled)
 
-    while break_condition not in ['jpg', 'jpeg', 'png']:
+        return _indexes[key]
 
-        # Pulling out a random image from a folder
-        rand_image = os.listdir(raw_folder)[random.randint(0, len(os.listdir(raw_folder))-1)]
 
-        # Splitting the name of the file on the '.', reversing the list, and taking the 0th element
-        # This approach is agnostic to the number of '.' in a filename
-        break_condition = rand_image.split('.')[::-1][0].lower()
+def image_grab(raw_folder):
+    """Picks a random image that has not been labeled yet
+
+    Args:
+        raw_folder: the folder of images to label, str
+
+    Returns:
+        the filename of the image, or None when everything has been labeled, str
+    """
 
+    # Returning the filename of the image
+    # The frontend joins this onto the images folder so that it can display the image
+    return get_index(raw_folder).random_image()
 
-    # Returning the full path of the image
-    # This full path will be used such that the frontend can display the image
-    # return os.path.join(raw_folder, rand_image)
-    # print(rand_image)
-    return os.path.join(rand_image)
 
+def image_name(image):
+    """The filename of an image, from the path that the frontend hands back
 
-def image_sort(raw_folder, image, sorted_folder, selection):
+    Args:
+        image: the path to the image, in the form ../static/images/file.png (with either kind of slash), str
+
+    Returns:
+        the filename, i.e. file.png, str
     """
 
+    return image.replace('\\', '/').split('/')[-1]
+
+
+def image_sort(raw_folder, image, selection):
+    """Takes a labeled image out of the queue of images to label. The image is not copied anywhere, the
+    label is a row in the database (see work_queue.complete_image()) and export_labels.py turns those
+    rows into class folders or TFRecords in bulk
+
     Args:
+        raw_folder: the folder of images to label, str
         image: the filepath to the image being sorted,  str
-        sorted_folder:
         selection: the user's selection for the class, str
 
     Returns:
-
+        the filename of the image, str
     """
     assert os.path.isdir(raw_folder), 'raw_folder does not exist'
-    assert os.path.isdir(os.path.join(sorted_folder, 'logo')), 'logo folder does not exist'
-    assert os.path.isdir(os.path.join(sorted_folder, 'no_logo')), 'no_logo folder does not exist'
+    assert selection in LABELS, f'selection must be one of: {", ".join(LABELS)}'
 
     # The filepath of the image needs to be resorted here as it comes in the form: ../static/images/file.png
-    image = image.replace('\\', '//').split('//')[len(image.replace('\\', '//').split('//'))-1]
+    image = image_name(image)
+
+    # So that image_grab() never hands it out again
+    get_index(raw_folder).mark_labeled(image)
 
-    # Making a copy of the image within the sorted folder
-    # That's right... a COPY. We need to retain the raw data
-    copy2(src=os.path.join(raw_folder, image), dst=os.path.join(sorted_folder, selection))
+    return image
@@ -0,0 +1,169 @@
+"""
+This script load tests the login and label submit routes of the app with a number of concurrent clients,
+against a throwaway database, and reports logins/sec, labels/sec and the number of failed requests.
+
+Every client is a Flask test client in its own thread, so the requests go through the whole app (routing,
+sessions, templates and the database) without a web server in between. The database is the part that
+clients actually contend for.
+
+Usage:
+    python load_test.py -clients 8 -seconds 10
+"""
+
+import os
+import re
+import time
+import shutil
+import tempfile
+import threading
+import argparse
+
+from app import app, init_app
+from db_utils.admin import create_user_db, create_user, setup_db
+from db_utils.database import close_all, query
+from db_utils.leaderboard import Leaderboard
+
+
+def _run_clients(n_clients, seconds, setup, step):
+    """Runs n_clients threads, each of which calls step(client) in a loop for a number of seconds
+
+    Args:
+        n_clients: the number of concurrent clients, int
+        seconds: how long to run for, numeric
+        setup: called with (client, i) once per client before the clock starts, function
+        step: makes one request and returns True if it succeeded, function
+
+    Returns:
+        (requests/sec, number of failed requests), tuple
+    """
+
+    clients = [app.test_client() for _ in range(n_clients)]
+    for i, client in enumerate(clients):
+        setup(client, i)
+
+    counts = [0] * n_clients
+    failures = [0] * n_clients
+    start_line = threading.Barrier(n_clients + 1)
+
+    def run(i):
+        start_line.wait()
+        deadline = time.perf_counter() + seconds
+
+        while time.perf_counter() < deadline:
+            try:
+                ok = step(clients[i])
+            except Exception:
+                ok = False
+
+            counts[i] += ok
+            failures[i] += not ok
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n_clients)]
+    for t in threads:
+        t.start()
+
+    start_line.wait()
+    tic = time.perf_counter()
+
+    for t in threads:
+        t.join()
+
+    return sum(counts) / (time.perf_counter() - tic), sum(failures)
+
+
+def load_test(n_clients=8, seconds=10., n_images=50000, write_behind=False, folder=None):
+    """Load tests the /logging-in and /logo-submit routes
+
+    Args:
+        n_clients: the number of concurrent clients, int
+        seconds: how long to test each route for, numeric
+        n_images: the number of (empty) images to label, int
+        write_behind: batch the count updates through a CountBuffer, bool
+        folder: where to put the test database and images, a temporary folder if not given, str
+
+    Returns:
+        {'login': (logins/sec, failed requests), 'label': (labels/sec, failed requests)}, dict
+    """
+
+    own_folder = folder is None
+    folder = tempfile.mkdtemp() if own_folder else folder
+
+    raw_folder = os.path.join(folder, 'images')
+    os.makedirs(raw_folder, exist_ok=True)
+
+    # The routes never decode the images, so empty files are enough
+    for i in range(n_images):
+        open(os.path.join(raw_folder, f'frame_{i:07d}.png'), 'wb').close()
+
+    db_name = os.path.join(folder, 'core')
+    create_user_db(db_name=db_name)
+    setup_db(db_name=db_name)
+
+    users = [f'annotator_{i}@example.com' for i in range(n_clients)]
+    for usr in users:
+        create_user(db_name=db_name, usr=usr, pswd='load-test', name=usr)
+
+    app.config['db_name'] = db_name
+    app.config['raw_folder'] = raw_folder
+    app.config['leaderboard'] = Leaderboard(db_name=db_name)
+    app.config['write_behind'] = write_behind
+    app.config['count_buffer'] = None
+    app.config['initialized'] = False
+    app.secret_key = os.urandom(12)
+    init_app()
+
+    results = {}
+
+    try:
+        # Every login is a bcrypt verify, which is slow on purpose. This is mostly a measure of that
+        def login(client):
+            response = client.post('/logging-in', data={'username': users[client.i], 'password': 'load-test'})
+            return response.status_code == 302 and response.headers['Location'].endswith('/dashboard')
+
+        # Each client plays one of the users
+        def set_user(client, i):
+            client.i = i
+
+        results['login'] = _run_clients(n_clients, seconds, set_user, login)
+
+        # A label is a dashboard load (which leases images) followed by the submit itself. The test stops
+        # making sense once every image has been labeled, so keep n_images well above labels/s * seconds
+        def submit(client):
+            page = client.get('/dashboard').get_data(as_text=True)
+            image = re.search(r'name="logo_path" value="([^"]*)"', page).group(1)
+            return client.post('/logo-submit', data={'logo_path': image}).status_code == 302
+
+        def log_in(client, i):
+            set_user(client, i)
+            assert login(client), 'the load test user could not log in'
+
+        results['label'] = _run_clients(n_clients, seconds, log_in, submit)
+
+        if write_behind:
+            app.config['count_buffer'].close()
+
+        # Every label has to show up in the counts, no matter how the submits interleaved
+        n_labels = query(db_name, """SELECT COUNT(*) FROM labels""")[0][0]
+        n_counted = query(db_name, """SELECT SUM(count) FROM users""")[0][0]
+        print(f'{n_labels} labels, {n_counted} counted')
+
+    finally:
+        close_all()
+        if own_folder:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    for route, (per_second, failed) in results.items():
+        print(f'{route}: {per_second:.1f} {route}s/s with {n_clients} clients, {failed} failed requests')
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-clients', type=int, default=8, help='the number of concurrent clients')
+    parser.add_argument('-seconds', type=float, default=10., help='how long to test each route for')
+    parser.add_argument('-images', type=int, default=50000, help='the number of images to label')
+    parser.add_argument('-write_behind', action='store_true', help='batch the count updates')
+    args = parser.parse_args()
+
+    load_test(n_clients=args.clients, seconds=args.seconds, n_images=args.images, write_behind=args.write_behind)
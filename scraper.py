@@ -1,30 +1,172 @@
 import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import requests
 import statsapi
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Where Scraper keeps the pages that it has fetched, between runs
+HTTP_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'cortex', 'http')
+
+# How long a MLB Stats API request that we make ourselves may take, in seconds
+STATSAPI_TIMEOUT = 30
+
+
+def _atomic_write(path, data):
+    """ Writes a file through a temporary file in the same folder that is then swapped in, so that a crash never
+    leaves half a file behind. The temporary file has a unique name, so threads (and processes) writing the same
+    file at once never trip over each other's
+    Args:
+        path: the file to write, str
+        data: what to write, bytes
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
 
 class Scraper:
-    def __init__(self, url):
+    """ Fetches a page and parses it with BeautifulSoup, with as little network I/O as possible:
+        - every Scraper shares one requests.Session, so connections are reused across pages and runs of a job
+        - failed requests (connection errors, 429 and 5xx) are retried with exponential backoff
+        - pages are cached on disk. A page younger than ttl is served straight from the cache, an older one is
+          revalidated with its ETag/Last-Modified, so an unchanged page costs an empty 304 instead of the page
+        - when the site is down, a cached copy (however old) is served instead of failing
+    Args:
+        url: the page to fetch, str
+        ttl: how long a cached page is served without asking the site, in seconds, numeric
+        timeout: how long to wait on the site, in seconds, numeric
+        cache_dir: where the cache lives, None to not cache, str
+        parse_only: only build the parts of the tree that match this, i.e. SoupStrainer('ol'), SoupStrainer
+    """
+    # Shared by every Scraper in the process
+    _session = None
+
+    def __init__(self, url, ttl=60 * 60, timeout=10, cache_dir=HTTP_CACHE_DIR, parse_only=None):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.cache_dir = cache_dir
+        self.parse_only = parse_only
         self.soup = self.get_soup(url)
-        pass
+
+    @classmethod
+    def session(cls, retries=3, backoff=.5):
+        """ The shared requests.Session, created on first use
+        Args:
+            retries: how many times a failed request is retried, int
+            backoff: the retries wait backoff, 2 * backoff, 4 * backoff, ... seconds, numeric
+        Returns:
+            requests.Session
+        """
+        if cls._session is None:
+            retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=frozenset(['GET', 'HEAD']))
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(max_retries=retry))
+            session.mount('https://', HTTPAdapter(max_retries=retry))
+            cls._session = session
+
+        return cls._session
+
+    def _cache_paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json'), os.path.join(self.cache_dir, key + '.body')
+
+    def _write_cache(self, url, meta, body=None):
+        meta_path, body_path = self._cache_paths(url)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Temporary files first, so that a crash never leaves a page without its metadata or the other way around
+        if body is not None:
+            _atomic_write(body_path, body)
+
+        _atomic_write(meta_path, json.dumps(meta).encode('utf-8'))
+
+    def get(self, url):
+        """ Fetches a page, through the cache
+        Args:
+            url: the page to fetch, str
+        Returns:
+            the body of the page, bytes
+        """
+        if self.cache_dir is None:
+            response = self.session().get(url, timeout=self.timeout)
+            response.raise_for_status()
+            return response.content
+
+        meta_path, body_path = self._cache_paths(url)
+        meta = None
+        if os.path.isfile(meta_path) and os.path.isfile(body_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+
+        # Fresh enough to not even ask
+        if meta is not None and time.time() - meta['fetched'] < self.ttl:
+            with open(body_path, 'rb') as f:
+                return f.read()
+
+        # Otherwise we ask the site whether the page changed since we fetched it
+        headers = {}
+        if meta is not None and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta is not None and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            response = self.session().get(url, headers=headers, timeout=self.timeout)
+            if response.status_code != 304:
+                response.raise_for_status()
+
+        except requests.RequestException as e:
+            if meta is None:
+                raise
+            print(f'Could not fetch {url} ({e!r}), using the cached copy from {time.ctime(meta["fetched"])}')
+            with open(body_path, 'rb') as f:
+                return f.read()
+
+        if response.status_code == 304:
+            meta['fetched'] = time.time()
+            self._write_cache(url, meta)
+            with open(body_path, 'rb') as f:
+                return f.read()
+
+        self._write_cache(url, {'fetched': time.time(),
+                                'etag': response.headers.get('ETag'),
+                                'last_modified': response.headers.get('Last-Modified')},
+                          response.content)
+
+        return response.content
 
     def get_soup(self, url):
-        req = requests.get(url)
-        return BeautifulSoup(req.content, features='lxml')
+        return BeautifulSoup(self.get(url), features='lxml', parse_only=self.parse_only)
 
 
-def power_rankings(link_to_site):
-    """ Use requests library to extract weekly ESPN MLB Power Rankings for use in Team Watchability Index calculation.
+# Only the <ol> elements (and what is inside of them) of the ESPN page are ever read
+RANKINGS_STRAINER = SoupStrainer('ol')
+
+
+def _parse_rankings(soup):
+    """ Reads the team rankings out of a parsed ESPN MLB Power Rankings page
     Args:
-        link_to_site: url to ESPN MLB Power Rankings website ('https://www.espn.com/mlb/powerrankings')
+        soup: the page, BeautifulSoup
     Returns:
-        {Date: {Team_1: Ranking, Team_2: Ranking, Team_3: Ranking, ..., Team_30: Ranking}}
+        {Team_1: Ranking, Team_2: Ranking, Team_3: Ranking, ..., Team_30: Ranking}
     """
-    # Retrieves section of website containing team rankings
-    soup = Scraper(url=link_to_site).soup
     power_ranking_team_list = soup.find_all('ol')[0]
     team_rankings = {}
 
@@ -33,21 +175,113 @@ def power_rankings(link_to_site):
         team_name = item.a.text
         team_rankings.update({team_name: count + 1})
 
+    return team_rankings
+
+
+def parse_power_rankings(html, targeted=True):
+    """ Parses a saved ESPN MLB Power Rankings page
+    Args:
+        html: the page, bytes or str
+        targeted: only build the <ol> subtrees instead of the tree of the whole page, bool
+    Returns:
+        {Team_1: Ranking, Team_2: Ranking, Team_3: Ranking, ..., Team_30: Ranking}
+    """
+    return _parse_rankings(BeautifulSoup(html, features='lxml', parse_only=RANKINGS_STRAINER if targeted else None))
+
+
+def power_rankings(link_to_site, targeted=True):
+    """ Use requests library to extract weekly ESPN MLB Power Rankings for use in Team Watchability Index calculation.
+    Args:
+        link_to_site: url to ESPN MLB Power Rankings website ('https://www.espn.com/mlb/powerrankings')
+        targeted: only build the <ol> subtrees of the page instead of the full tree, which is faster and lighter, bool
+    Returns:
+        {Date: {Team_1: Ranking, Team_2: Ranking, Team_3: Ranking, ..., Team_30: Ranking}}
+    """
+    # Retrieves section of website containing team rankings
+    soup = Scraper(url=link_to_site, parse_only=RANKINGS_STRAINER if targeted else None).soup
+    team_rankings = _parse_rankings(soup)
+
     # Creates dictionary of rankings using {date : team_rankings} structure
     dict_of_rankings = {datetime.datetime.today().strftime('%m-%d-%Y'): team_rankings}
 
     return dict_of_rankings
 
 
-def team_records():
-    """ Use MLB Stats API to extract daily MLB Team Records for use in Game Watchability Index calculation
+def save_fixture(url, path):
+    """ Saves a page to disk, i.e. to use with benchmark_parsers()
+    Args:
+        url: the page to save, str
+        path: where to save it, str
+    """
+    with open(path, 'wb') as f:
+        f.write(Scraper.session().get(url, timeout=10).content)
 
+
+def benchmark_parsers(fixtures=None, n_repeats=5):
+    """ Compares the parse time and peak memory of building the full tree of a power rankings page against only
+    building its <ol> subtrees, and checks that both read the same rankings
+    Args:
+        fixtures: paths to saved pages (see save_fixture()). A synthetic page is made up if not given, list
+        n_repeats: the best of this many parses is reported, int
+    Returns:
+        {fixture: {'full': (seconds, peak bytes), 'targeted': (seconds, peak bytes)}}
+    """
+    import tracemalloc
+
+    pages = {}
+    if fixtures:
+        for fixture in fixtures:
+            with open(fixture, 'rb') as f:
+                pages[fixture] = f.read()
+    else:
+        # Roughly the shape of the ESPN page: a lot of navigation, scripts and articles around one short list
+        filler = ''.join(f'<div class="story"><h2><a href="/story/{i}">Headline {i}</a></h2>'
+                         f'<p>{"Lorem ipsum dolor sit amet. " * 20}</p><ul>' +
+                         ''.join(f'<li><a href="/link/{i}/{j}">Link {j}</a></li>' for j in range(10)) +
+                         '</ul></div>' for i in range(400))
+        rankings = '<ol>' + ''.join(f'<li><a href="/team/{i}">Team {i}</a> <span>{i}-{30 - i}</span></li>'
+                                    for i in range(30)) + '</ol>'
+        pages['synthetic'] = f'<html><head><script>{"var x = 1; " * 5000}</script></head><body>{filler}{rankings}' \
+                             f'{filler}</body></html>'.encode('utf-8')
+
+    results = {}
+    for name, html in pages.items():
+        results[name] = {}
+        for mode, targeted in (('full', False), ('targeted', True)):
+            times = []
+            for _ in range(n_repeats):
+                start = time.perf_counter()
+                parse_power_rankings(html, targeted=targeted)
+                times.append(time.perf_counter() - start)
+
+            tracemalloc.start()
+            parse_power_rankings(html, targeted=targeted)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            results[name][mode] = (min(times), peak)
+
+        assert parse_power_rankings(html, targeted=True) == parse_power_rankings(html, targeted=False), \
+            f'the targeted parse of {name} read different rankings'
+
+        full, targeted = results[name]['full'], results[name]['targeted']
+        print(f'{name} ({len(html) / 1024:.0f} KiB): full {full[0] * 1000:.1f}ms / {full[1] / 2 ** 20:.1f} MiB, '
+              f'targeted {targeted[0] * 1000:.1f}ms / {targeted[1] / 2 ** 20:.1f} MiB '
+              f'({full[0] / targeted[0]:.1f}x faster, {full[1] / targeted[1]:.1f}x less memory)')
+
+    return results
+
+
+def team_records(date=None):
+    """ Use MLB Stats API to extract daily MLB Team Records for use in Game Watchability Index calculation
+    Args:
+        date: the day to get the records as of, 'YYYY-MM-DD', today if not given, str
     Returns:
         {Date: {Team_Name: (Wins, Losses), Team_Name: (Wins, Losses), ..., Team_Name: (Wins, Losses)}}
     """
-    # Retrieve today's league standings
-    today = datetime.datetime.today().strftime('%Y-%m-%d')
-    standings = statsapi.standings_data()
+    # Retrieve the league standings as of the day (today's by default). The API wants the date as MM/DD/YYYY
+    today = date or datetime.datetime.today().strftime('%Y-%m-%d')
+    standings = statsapi.standings_data(date=datetime.datetime.strptime(today, '%Y-%m-%d').strftime('%m/%d/%Y'))
 
     # League Codes:
     # 200 - AL West
@@ -73,14 +307,117 @@ def team_records():
     return records_dict
 
 
-def team_schedule():
-    """ Use MLB Stats API to extract daily MLB Team Schedules for use in Game Watchability Index calculation
+# The team id -> fileCode lookup table is cached on disk between runs, and refreshed after TEAM_CACHE_TTL seconds
+TEAM_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'cortex', 'team_codes.json')
+TEAM_CACHE_TTL = 7 * 24 * 60 * 60
+
+# ...and in memory for the life of the process. The lock keeps threads (i.e. the days of a backfill) from loading
+# or refreshing the table at the same time
+_team_codes = None
+_team_codes_lock = threading.RLock()
+
+# Set by invalidate_team_codes(), the next team_codes() refetches the table whatever its age
+_team_codes_stale = False
+
+# Ids that are still unknown after a refresh, i.e. the All-Star teams and exhibition opponents
+_unknown_team_ids = set()
+
+
+def team_codes(cache_file=None, ttl=TEAM_CACHE_TTL):
+    """ The fileCode of every MLB team, by team id. Loaded once per process, from the on-disk cache if it is younger
+    than ttl and otherwise with a single teams request (statsapi.lookup_team() makes two requests per team)
+    Args:
+        cache_file: where the table is cached between runs, TEAM_CACHE_FILE if not given, str
+        ttl: how long the cached table is trusted for, in seconds, numeric
+    Returns:
+        {Team_ID: fileCode}
+    """
+    with _team_codes_lock:
+        return _load_team_codes(cache_file or TEAM_CACHE_FILE, ttl)
+
+
+def _load_team_codes(cache_file, ttl):
+    """ team_codes(), with _team_codes_lock held """
+    global _team_codes, _team_codes_stale
+
+    if _team_codes is not None and not _team_codes_stale:
+        return _team_codes
+
+    cached = None
+    if os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            cached = json.load(f)
+
+        if not _team_codes_stale and time.time() - cached['fetched'] < ttl:
+            _team_codes = {int(team_id): code for team_id, code in cached['codes'].items()}
+            return _team_codes
+
+    # One attempt per load or invalidation, so that an API that is down is not asked again for every team
+    _team_codes_stale = False
+
+    try:
+        teams = statsapi.get('teams', {'sportId': 1, 'activeStatus': 'Y', 'fields': 'teams,id,fileCode'},
+                             request_kwargs={'timeout': STATSAPI_TIMEOUT})['teams']
+        codes = {team['id']: team['fileCode'] for team in teams}
+
+    except Exception as e:
+        # A stale table beats no table when the API is down, the one in memory if there is one, else the one on disk
+        if _team_codes is None and cached is None:
+            raise
+        print(f'Could not refresh the team codes ({e!r}), using the cached ones')
+        if _team_codes is None:
+            _team_codes = {int(team_id): code for team_id, code in cached['codes'].items()}
+        return _team_codes
+
+    # The new table only replaces the old one (in memory and on disk) once it is in hand
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    _atomic_write(cache_file, json.dumps({'fetched': time.time(), 'codes': codes}).encode('utf-8'))
+
+    _team_codes = codes
+    return _team_codes
 
+
+def invalidate_team_codes():
+    """ Marks the team lookup table as out of date, i.e. after a team relocates or is renamed. The next team_codes()
+    refetches it, and the current table (in memory and on disk) stays in use until a refetch succeeds
+    """
+    global _team_codes_stale
+
+    with _team_codes_lock:
+        _team_codes_stale = True
+
+
+def team_code(team_id, cache_file=None):
+    """ The fileCode of a single team
+    Args:
+        team_id: the MLB Stats API team id, int
+        cache_file: where the table is cached between runs, TEAM_CACHE_FILE if not given, str
+    Returns:
+        the fileCode, i.e. 'nyy', str. None for a team that is not in the table, even after a refresh
+    """
+    codes = team_codes(cache_file)
+    if team_id in codes:
+        return codes[team_id]
+
+    # A team that the table has never heard of can mean that the table is out of date, so it is refreshed, but only
+    # once per id. Ids that are still missing afterwards are not MLB clubs (All-Star teams, exhibition opponents)
+    with _team_codes_lock:
+        if team_id not in _unknown_team_ids:
+            _unknown_team_ids.add(team_id)
+            invalidate_team_codes()
+
+        return team_codes(cache_file).get(team_id)
+
+
+def team_schedule(date=None):
+    """ Use MLB Stats API to extract daily MLB Team Schedules for use in Game Watchability Index calculation
+    Args:
+        date: the day to get the schedule of, 'YYYY-MM-DD', today if not given, str
     Returns:
         {Date: {H1: Team_Name, A1: Team_Name, ..., H8: Team_Name, A8: Team_Name}}
     """
-    # Retrieve schedule of today's games
-    today = datetime.datetime.today().strftime('%Y-%m-%d')
+    # Retrieve schedule of the day's games, today's by default
+    today = date or datetime.datetime.today().strftime('%Y-%m-%d')
     schedule = statsapi.schedule(today)
 
     # Team Codes:
@@ -116,12 +453,18 @@ def team_schedule():
     # 158	MIL	Brewers
 
     # Convert Team Codes into Abbreviations and use as new dictionary values
+    # The lookup table is loaded once, so the schedule is the only request that this makes
+    # Games against teams outside of the table (All-Star games, exhibitions) are left out
     daily_schedule = {}
-    for team in range(len(schedule)):
-        home_team = statsapi.lookup_team(schedule[team]['home_id'])[0]['fileCode'].upper()
-        away_team = statsapi.lookup_team(schedule[team]['away_id'])[0]['fileCode'].upper()
-        daily_schedule.update({'H' + str(team): home_team,
-                               'A' + str(team): away_team})
+    for game in schedule:
+        home_team = team_code(game['home_id'])
+        away_team = team_code(game['away_id'])
+        if home_team is None or away_team is None:
+            continue
+
+        team = len(daily_schedule) // 2
+        daily_schedule.update({'H' + str(team): home_team.upper(),
+                               'A' + str(team): away_team.upper()})
 
     # Append previous dictionary to main dictionary
     team_schedules = {today: daily_schedule}
@@ -129,42 +472,269 @@ def team_schedule():
     return team_schedules
 
 
-def box_scores():
-    """ Use MLB Stats API to extract daily MLB box scores for use in Live Game Watchability Index calculation
+class RateLimiter:
+    """ Spaces out requests so that no more than per_second of them start in any second, across every thread that
+    shares the limiter
+    Args:
+        per_second: the most requests to start per second, numeric
+    """
+    def __init__(self, per_second):
+        self.interval = 1. / per_second
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """ Blocks until the caller may start its next request """
+        # Every caller books the next free slot and then sleeps until it comes up, outside of the lock
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _run_concurrently(calls, max_concurrency, timeout, limiter=None):
+    """ Runs blocking calls (i.e. MLB Stats API requests) in a thread pool, with at most max_concurrency of them in
+    flight at once. A call that runs for longer than timeout seconds is given up on.
+    Args:
+        calls: (function, args) pairs, list
+        max_concurrency: the most calls in flight at once, int
+        timeout: how long a single call may run for, in seconds, numeric
+        limiter: if given, every call waits on it before it starts, RateLimiter
+    Returns:
+        the result of every call in order, None for calls that failed or timed out, list. Failures are printed
+        and skipped rather than raised, so one bad call does not lose the results of all of the others
+    """
+    # The clock of a call starts when a thread picks it up (and the limiter lets it go), not when it gets queued
+    started = {}
+
+    def timed(i, fn, args):
+        if limiter is not None:
+            limiter.wait()
+        started[i] = time.monotonic()
+        return fn(*args)
+
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    futures = {executor.submit(timed, i, fn, args): i for i, (fn, args) in enumerate(calls)}
+    results = [None] * len(calls)
+    pending = set(futures)
+
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=min(timeout, 1.), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    print(f'{calls[futures[future]][0].__name__}{calls[futures[future]][1]} failed: {e!r}')
+
+            # A thread cannot be cancelled, only left behind, so calls have to time out their own requests as well
+            now = time.monotonic()
+            for future in [f for f in pending if now - started.get(futures[f], now) > timeout]:
+                print(f'{calls[futures[future]][0].__name__}{calls[futures[future]][1]} timed out after {timeout}s')
+                pending.discard(future)
+
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return results
+
+
+# Everything that a box score needs out of the game feed: the team abbreviations and the linescore
+GAME_FIELDS = 'gameData,teams,abbreviation,teamName,status,abstractGameState,liveData,linescore,innings,num,home,' \
+              'away,runs,hits,errors'
+
 
+def _linescore_rows(game):
+    """ The (home, away) rows of a game's linescore, formatted the same as by statsapi.linescore()
+    Args:
+        game: the game feed, with at least GAME_FIELDS, dict
     Returns:
-        {Date: {Home-Away First Code: (Home Score, Away Score), ..., Home-Away Last Code: (Home Score, Away Score)}}
+        (home row, away row), tuple of str
     """
-    # Create dynamic variable to get yesterday's box scores
-    yesterday = (datetime.datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
-    schedule = statsapi.schedule(yesterday)
+    header_name = game['gameData']['status']['abstractGameState']
+    names = {side: game['gameData']['teams'][side]['teamName'] for side in ('away', 'home')}
+    linescore = game['liveData']['linescore']
+    innings = linescore['innings']
+
+    rows = {}
+    for side in ('away', 'home'):
+        runs = [str(inning.get(side, {}).get('runs', 0)) for inning in innings] + [' '] * (9 - len(innings))
+        totals = linescore.get('teams', {}).get(side, {})
+        rhe = [str(totals.get(stat, 0)) for stat in ('runs', 'hits', 'errors')]
+
+        width = len(max([header_name, names['away'], names['home']], key=len)) + 1
+        rows[side] = ('{:<%s}' % width).format(names[side]) + ('{:^2}' * len(runs)).format(*runs) + \
+                     ('{:^4}' * 3).format(*rhe)
+
+    return rows['home'], rows['away']
 
-    # Retrieve values from schedule dictionary
-    game_info = [list(schedule[i].values()) for i in range(len(schedule))]
 
-    # Extract game codes from schedule dictionary values
-    game_codes = [game_info[i][0] for i in range(len(game_info))]
+def _box_score(game_code, timeout):
+    """ One game feed request per game, with a real timeout (statsapi.boxscore_data() and statsapi.linescore() do not
+    take one, and would make a request each)
+    Args:
+        game_code: the MLB Stats API gamePk, int
+        timeout: how long the request may take, in seconds, numeric
+    Returns:
+        (Home-Away Code, (Home Score, Away Score))
+    """
+    game = statsapi.get('game', {'gamePk': game_code, 'fields': GAME_FIELDS}, request_kwargs={'timeout': timeout})
+    teams = game['gameData']['teams']
+
+    return teams['home']['abbreviation'] + teams['away']['abbreviation'], _linescore_rows(game)
+
+
+def _fetch_box_scores(game_codes, max_concurrency=16, timeout=10., limiter=None, failed=None):
+    """ Fetches the box scores of a list of games concurrently. Every game takes one game feed request, and all of
+    them are in flight at once (up to max_concurrency)
+    Args:
+        game_codes: MLB Stats API gamePks, list
+        max_concurrency: the most requests in flight at once, int
+        timeout: how long a single request may take, in seconds, numeric
+        limiter: if given, every request waits on it before it starts, RateLimiter
+        failed: if given, the game codes whose requests failed are appended to it, list
+    Returns:
+        {Game Code: (Home-Away Code, (Home Score, Away Score))}, games whose requests failed are left out
+    """
+    results = _run_concurrently([(_box_score, (game_code, timeout)) for game_code in game_codes], max_concurrency,
+                                timeout, limiter=limiter)
+
+    # Keyed by game code, as the two games of a doubleheader share their Home-Away Code
+    box_score = {}
+    for game_code, result in zip(game_codes, results):
+        if result is None:
+            if failed is not None:
+                failed.append(game_code)
+            continue
 
-    # Use game codes to retrieve all info for correct games
-    home_away = []
-    for i in range(len(game_codes)):
-        home_away.append(statsapi.boxscore_data(game_codes[i]))
+        box_score.update({game_code: result})
 
-    # Use game codes to retrieve box scores for correct games
-    boxes = []
-    for i in range(len(game_codes)):
-        home_box = (statsapi.linescore(game_codes[i]).splitlines()[2])
-        away_box = (statsapi.linescore(game_codes[i]).splitlines()[1])
-        boxes.extend([home_box, away_box])
+    return box_score
+
+
+# Games in these states never get a box score
+NO_BOX_SCORE_STATES = ('Postponed', 'Cancelled')
+
+
+def box_scores(date=None, max_concurrency=16, timeout=10., limiter=None, failed=None):
+    """ Use MLB Stats API to extract daily MLB box scores for use in Live Game Watchability Index calculation. A game
+    whose requests fail or time out is printed and left out of the result, it does not raise (pass failed to find
+    out which games those were)
+    Args:
+        date: the day to get the box scores of, 'YYYY-MM-DD', yesterday if not given, str
+        max_concurrency: the most MLB Stats API requests in flight at once, int
+        timeout: how long a single request may take before its game is skipped, in seconds, numeric
+        limiter: if given, every request waits on it before it starts, RateLimiter
+        failed: if given, the game codes of the games that were skipped are appended to it, list
+    Returns:
+        {Date: {Home-Away First Code: (Home Score, Away Score), ..., Home-Away Last Code: (Home Score, Away Score)}}.
+        The second game of a doubleheader is keyed Home-Away Code-2
+    """
+    # Create dynamic variable to get yesterday's box scores (or the given day's)
+    yesterday = date or (datetime.datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
+    if limiter is not None:
+        limiter.wait()
+    schedule = [game for game in statsapi.schedule(yesterday) if game.get('status') not in NO_BOX_SCORE_STATES]
+
+    # Extract game codes (and the game number, which tells the two games of a doubleheader apart) from the schedule
+    game_codes = [game['game_id'] for game in schedule]
+    game_numbers = {game['game_id']: game.get('game_num', 1) for game in schedule}
+
+    # Use game codes to retrieve all info and box scores for correct games, all games at once
+    games = _fetch_box_scores(game_codes, max_concurrency=max_concurrency, timeout=timeout, limiter=limiter,
+                              failed=failed)
 
     # Create dictionary with Home-Away concatenation as key and scores as values
     box_score = {}
-    for i in range(len(home_away)):
-        home_away_codes = (list(home_away[i]['teamInfo']['home'].values())[1] +
-                           list(home_away[i]['teamInfo']['away'].values())[1])
-        box_score.update({home_away_codes: (boxes[i * 2], boxes[(i * 2) + 1])})
+    for game_code, (home_away_codes, rows) in games.items():
+        if game_numbers[game_code] > 1:
+            home_away_codes += '-' + str(game_numbers[game_code])
+        box_score.update({home_away_codes: rows})
 
     # Create main dictionary with date as key and box score dictionary as value
     score_dict = {yesterday: box_score}
 
     return score_dict
+
+
+def benchmark_box_scores(n_games=15, latency=.25, max_concurrency=16):
+    """ Times fetching a day of box scores the old way (three requests per game, one after the other) against
+    _fetch_box_scores(), with the MLB Stats API swapped out for a local stub server that answers every request
+    with a canned game after a fixed delay
+    Args:
+        n_games: the number of games in the day, int
+        latency: how long the stub takes to answer a request, in seconds, numeric
+        max_concurrency: passed to _fetch_box_scores(), int
+    Returns:
+        {'serial': seconds, 'concurrent': seconds}
+    """
+    import json
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from statsapi.endpoints import ENDPOINTS, BASE_URL
+
+    # Just enough of a game feed for boxscore_data() and linescore()
+    batting = {k: 0 for k in ['atBats', 'runs', 'hits', 'doubles', 'triples', 'homeRuns', 'rbi', 'stolenBases',
+                              'strikeOuts', 'baseOnBalls', 'leftOnBase', 'avg', 'ops', 'obp', 'slg']}
+    pitching = {k: 0 for k in ['inningsPitched', 'hits', 'runs', 'earnedRuns', 'baseOnBalls', 'strikeOuts',
+                               'homeRuns', 'era', 'numberOfPitches', 'strikes', 'pitchesThrown']}
+    feed = json.dumps({
+        'gameData': {'game': {'id': 'stub'}, 'status': {'abstractGameState': 'Final'}, 'players': {},
+                     'teams': {'away': {'id': 147, 'abbreviation': 'NYY', 'teamName': 'Yankees', 'shortName': 'NYY'},
+                               'home': {'id': 111, 'abbreviation': 'BOS', 'teamName': 'Red Sox', 'shortName': 'BOS'}}},
+        'liveData': {'linescore': {'innings': [{'num': i, 'home': {'runs': 1}, 'away': {'runs': 0}} for i in range(1, 10)],
+                                   'teams': {'home': {'runs': 9, 'hits': 10, 'errors': 0},
+                                             'away': {'runs': 0, 'hits': 3, 'errors': 1}}},
+                     'boxscore': {'info': [], 'teams': {side: {'team': {'id': 0}, 'players': {}, 'batters': [],
+                                                               'pitchers': [], 'info': [], 'note': [],
+                                                               'teamStats': {'batting': batting, 'pitching': pitching}}
+                                                        for side in ('home', 'away')}}},
+    }).encode('utf-8')
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(feed)))
+            self.end_headers()
+            self.wfile.write(feed)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Pointing statsapi at the stub for the length of the benchmark
+    original_urls = {name: endpoint['url'] for name, endpoint in ENDPOINTS.items()}
+    for endpoint in ENDPOINTS.values():
+        endpoint['url'] = endpoint['url'].replace(BASE_URL, f'http://127.0.0.1:{server.server_port}/api/')
+
+    game_codes = list(range(n_games))
+    results = {}
+
+    try:
+        start = time.perf_counter()
+        for game_code in game_codes:
+            statsapi.boxscore_data(game_code)
+            statsapi.linescore(game_code).splitlines()[2]
+            statsapi.linescore(game_code).splitlines()[1]
+        results['serial'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _fetch_box_scores(game_codes, max_concurrency=max_concurrency)
+        results['concurrent'] = time.perf_counter() - start
+
+    finally:
+        for name, url in original_urls.items():
+            ENDPOINTS[name]['url'] = url
+        server.shutdown()
+
+    print(f'{n_games} games at {latency}s per request: serial {results["serial"]:.2f}s, '
+          f'concurrent {results["concurrent"]:.2f}s ({results["serial"] / results["concurrent"]:.1f}x)')
+
+    return results
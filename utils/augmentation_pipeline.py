@@ -0,0 +1,291 @@
+"""
+This module chains the helpers in augmentation.py into a pipeline, and runs that pipeline in a pool of
+worker processes so that augmentation happens off of the training thread.
+
+Usage:
+    pipeline = Compose([Erase(p=.5), Rotate(p=.25, levels=(2,)), Blur(sigma=1, p=.1)], seed=42)
+
+    with AugmentationExecutor(pipeline, n_workers=8) as executor:
+        for batch in executor.map(batches):
+            train_step(batch)
+
+Every sample gets its own random generator, seeded from (seed, index of the sample in the stream). The
+augmentations that a sample receives therefore do not depend on which worker it landed on, or on how
+many workers there are, so a run can be reproduced on a box with a different number of cores.
+"""
+
+import multiprocessing
+import traceback
+from itertools import chain
+
+import numpy as np
+
+from augmentation import random_erasing, random_crop, rotation, gaussian_blue
+
+
+class Erase:
+    """random_erasing(), applied with probability p"""
+
+    def __init__(self, p=.5):
+        self.p = p
+
+    def __call__(self, image, rng):
+        return random_erasing(image, rng=rng)
+
+
+class Crop:
+    """random_crop() to (h, w), applied with probability p. Use p=1 inside of an AugmentationExecutor,
+    as every sample in a batch has to come out the same shape"""
+
+    def __init__(self, w, h, p=1.):
+        self.w = w
+        self.h = h
+        self.p = p
+
+    def __call__(self, image, rng):
+        return random_crop(image, self.w, self.h, rng=rng)
+
+
+class Rotate:
+    """rotation() by a level drawn from levels, applied with probability p. Levels 1 and 3 swap the rows
+    and cols, so they only belong in an AugmentationExecutor pipeline when the images are square"""
+
+    def __init__(self, p=.5, levels=(2,)):
+        self.p = p
+        self.levels = levels
+
+    def __call__(self, image, rng):
+        return rotation(image, self.levels[rng.integers(len(self.levels))])
+
+
+class Blur:
+    """gaussian_blue() with a sigma drawn uniformly from [sigma_low, sigma_high], applied with probability p"""
+
+    def __init__(self, sigma, p=.5, sigma_high=None):
+        self.sigma = sigma
+        self.sigma_high = sigma if sigma_high is None else sigma_high
+        self.p = p
+
+    def __call__(self, image, rng):
+        return gaussian_blue(image, rng.uniform(self.sigma, self.sigma_high))
+
+
+class Compose:
+    """Applies a list of ops to an image, in order, each one with its own probability
+
+    Args:
+        ops: the ops to apply, i.e. [Erase(p=.5), Blur(sigma=2, p=.1)], list
+        seed: the base seed of the pipeline, int
+    """
+
+    def __init__(self, ops, seed=0):
+        self.ops = ops
+        self.seed = seed
+
+    def __call__(self, image, index):
+        """Augments a single image
+
+        Args:
+            image: an image, which may be modified in place, np.array
+            index: the position of the image in the stream of samples, which seeds its randomness, int
+
+        Returns:
+            the augmented image, np.array
+        """
+
+        rng = np.random.default_rng([self.seed, index])
+
+        for op in self.ops:
+            # Drawing the coin flip even for ops with p == 1 keeps the stream of random numbers that
+            # each op sees the same when the probabilities of the other ops are changed
+            if rng.random() < op.p:
+                image = op(image, rng)
+
+        return image
+
+    def apply_batch(self, images, start_index=0):
+        """Augments a (N, H, W, C) batch in the current process
+
+        Args:
+            images: a batch of images, which may be modified in place, np.array
+            start_index: the position of the first image in the stream of samples, int
+
+        Returns:
+            the augmented batch, np.array
+        """
+
+        return np.stack([self(image, start_index + i) for i, image in enumerate(images)])
+
+
+def _worker(pipeline, inputs, outputs, in_shape, out_shape, in_dtype, out_dtype, jobs, results):
+    """The AugmentationExecutor worker loop. Takes (slot, number of images, index of the first image) jobs
+    off of the queue. This lives outside of the class so that spawning a worker does not pickle the executor
+
+    Returns:
+
+    """
+
+    in_buffer = np.frombuffer(inputs, dtype=in_dtype).reshape((-1,) + in_shape)
+    out_buffer = np.frombuffer(outputs, dtype=out_dtype).reshape((-1,) + out_shape)
+
+    while True:
+
+        job = jobs.get()
+
+        # A None is the signal to shut down
+        if job is None:
+            break
+
+        slot, n, start_index = job
+
+        try:
+            for i in range(n):
+                image = pipeline(in_buffer[slot, i], start_index + i)
+
+                if image.shape != out_shape[1:]:
+                    raise ValueError(f'the pipeline output a {image.shape} image where the first one was '
+                                     f'{out_shape[1:]}, i.e. Rotate(levels=(1, 3)) on non-square images')
+
+                out_buffer[slot, i] = image
+            results.put((slot, None))
+
+        except Exception:
+            results.put((slot, traceback.format_exc()))
+
+
+class AugmentationExecutor:
+    """Runs a Compose pipeline over a stream of batches in a pool of worker processes
+
+    Batches travel through a ring of `prefetch` shared-memory slots: the parent copies a batch into a
+    free input slot, a worker augments it straight into the matching output slot, and only the slot
+    index goes through the queues. Nothing is pickled, and at most `prefetch` batches are ever in
+    memory, no matter how far ahead of the consumer the workers get.
+
+    The slots are sized off of the first batch, so every batch needs the same image shape and no more
+    images than the first one, and the pipeline has to always output the same shape.
+
+    Args:
+        pipeline: the pipeline to run, Compose
+        n_workers: the number of worker processes, int
+        prefetch: the number of batches that can be in flight at once, defaults to 2 * n_workers, int
+    """
+
+    def __init__(self, pipeline, n_workers, prefetch=None):
+        self.pipeline = pipeline
+        self.n_workers = n_workers
+        self.prefetch = prefetch or 2 * n_workers
+        self.workers = []
+
+    def _start(self, first_batch):
+        """Sizes the shared slots off of the first batch and starts the workers"""
+
+        sample_out = self.pipeline(first_batch[0].copy(), 0)
+
+        self.in_shape = first_batch.shape
+        self.out_shape = (len(first_batch),) + sample_out.shape
+        self.in_dtype = first_batch.dtype
+        self.out_dtype = sample_out.dtype
+
+        inputs = multiprocessing.RawArray('B', self.prefetch * first_batch.nbytes)
+        outputs = multiprocessing.RawArray('B', self.prefetch * int(np.prod(self.out_shape)) * sample_out.itemsize)
+
+        self.in_buffer = np.frombuffer(inputs, dtype=self.in_dtype).reshape((-1,) + self.in_shape)
+        self.out_buffer = np.frombuffer(outputs, dtype=self.out_dtype).reshape((-1,) + self.out_shape)
+
+        self.jobs = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+
+        self.workers = [multiprocessing.Process(target=_worker,
+                                                args=(self.pipeline, inputs, outputs, self.in_shape, self.out_shape,
+                                                      self.in_dtype, self.out_dtype, self.jobs, self.results, ),
+                                                daemon=True)
+                        for _ in range(self.n_workers)]
+
+        for p in self.workers:
+            p.start()
+
+    def map(self, batches, copy=True):
+        """Augments a stream of batches, yielding them in the order that they came in
+
+        Args:
+            batches: (N, H, W, C) batches, iterable of np.array
+            copy: yield copies of the output slots. With copy=False the yielded array is a view into a
+                  slot that gets reused as soon as the next batch is asked for, bool
+
+        Returns:
+            yields augmented batches, np.array
+        """
+
+        batches = iter(batches)
+        first_batch = next(batches, None)
+
+        if first_batch is None:
+            return
+
+        if not self.workers:
+            self._start(first_batch)
+
+        free_slots = list(range(self.prefetch))
+        in_flight = []    # (slot, number of images) in the order that the batches came in
+        finished = set()
+        start_index = 0
+
+        def wait_for_oldest():
+            # Results come back in whatever order the workers finish, but we hand them out in order
+            while in_flight[0][0] not in finished:
+                slot, error = self.results.get()
+                finished.add(slot)
+                if error is not None:
+                    raise RuntimeError(f'augmentation worker failed:\n{error}')
+
+            slot, n = in_flight.pop(0)
+            finished.remove(slot)
+            return slot, n
+
+        try:
+            for batch in chain([first_batch], batches):
+
+                assert batch.shape[1:] == self.in_shape[1:] and len(batch) <= self.in_shape[0], \
+                    'every batch needs the same image shape, and no more images than the first batch'
+
+                # All of the slots are busy, so the oldest batch has to be handed out first
+                if not free_slots:
+                    slot, n = wait_for_oldest()
+                    yield self.out_buffer[slot, :n].copy() if copy else self.out_buffer[slot, :n]
+                    free_slots.append(slot)
+
+                slot = free_slots.pop()
+                self.in_buffer[slot, :len(batch)] = batch
+                self.jobs.put((slot, len(batch), start_index))
+                in_flight.append((slot, len(batch)))
+                start_index += len(batch)
+
+            # Draining whatever is left
+            while in_flight:
+                slot, n = wait_for_oldest()
+                yield self.out_buffer[slot, :n].copy() if copy else self.out_buffer[slot, :n]
+                free_slots.append(slot)
+
+        finally:
+            # A consumer that stops early (or a worker error) leaves batches in flight. Waiting them out here
+            # means that the next .map() never picks up their results, or has a worker write into its slots
+            outstanding = set(slot for slot, _ in in_flight) - finished
+            while outstanding:
+                outstanding.discard(self.results.get()[0])
+
+    def close(self):
+        """Shuts the workers down"""
+
+        for _ in self.workers:
+            self.jobs.put(None)
+
+        for p in self.workers:
+            p.join()
+
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,115 @@
+"""
+This module contains a filter for dropping near-duplicate frames while a video is being split into images.
+
+Broadcast footage holds on the same shot for seconds at a time, so taking every nth frame still gives us
+long runs of frames that are, for labeling purposes, the same image. The FrameFilter compares each frame
+against the last frame that was kept and only lets it through when it is different enough.
+"""
+
+import numpy as np
+import cv2
+
+
+class FrameFilter:
+    """A stateful near-duplicate filter. Call .keep() on every frame, in order, and only write the
+    frames that it returns True for.
+
+    Two ways of measuring the difference between frames are available:
+        'dhash': a 64-bit difference hash of a 9x8 greyscale thumbnail. The difference is the number
+                 of bits that changed (0-64). Cheap, and robust to small changes in brightness.
+        'hist': a 3D colour histogram of a small thumbnail. The difference is the Bhattacharyya
+                distance (0-1) between the histograms. Better at catching actual scene changes.
+
+    Both only ever look at a heavily downscaled copy of the frame, so the cost per frame is tiny
+    compared to decoding it, let alone encoding it.
+    """
+
+    # The default thresholds, a frame at or below these is considered a duplicate
+    default_thresholds = {'dhash': 5, 'hist': 0.1}
+
+    def __init__(self, method='dhash', threshold=None):
+
+        assert method in self.default_thresholds, 'method must be one of: dhash, hist'
+
+        self.method = method
+        self.threshold = self.default_thresholds[method] if threshold is None else threshold
+        self.n_kept = 0
+        self.n_dropped = 0
+        self._last = None
+
+    def _signature(self, img):
+        """Reduces a frame down to the thing that we compare between frames
+
+        Args:
+            img: a BGR frame, np.array
+
+        Returns:
+            a bool np.array of 64 bits for 'dhash', a normalized float32 np.array histogram for 'hist'
+        """
+
+        if self.method == 'dhash':
+            # INTER_AREA averages over the pixels that are being shrunk together, which is what
+            # makes the hash stable against noise and compression artifacts
+            small = cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), (9, 8), interpolation=cv2.INTER_AREA)
+            return (small[:, 1:] > small[:, :-1]).ravel()
+
+        small = cv2.resize(img, (64, 36), interpolation=cv2.INTER_AREA)
+        hist = cv2.calcHist([small], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
+        return cv2.normalize(hist, hist).ravel()
+
+    def _difference(self, signature):
+        """How different a signature is from the signature of the last kept frame
+
+        Args:
+            signature: the output of ._signature(), np.array
+
+        Returns:
+            the difference, numeric. inf if nothing has been kept yet
+        """
+
+        if self._last is None:
+            return float('inf')
+
+        if self.method == 'dhash':
+            return int(np.count_nonzero(signature != self._last))
+
+        return cv2.compareHist(signature, self._last, cv2.HISTCMP_BHATTACHARYYA)
+
+    def difference(self, img):
+        """How different a frame is from the last kept frame. Does not change the state of the filter
+
+        Args:
+            img: a BGR frame, np.array
+
+        Returns:
+            the difference, numeric. inf if nothing has been kept yet
+        """
+
+        return self._difference(self._signature(img))
+
+    def keep(self, img):
+        """Decides whether or not a frame should be kept. Kept frames become the new reference
+
+        Args:
+            img: a BGR frame, np.array
+
+        Returns:
+            bool
+        """
+
+        signature = self._signature(img)
+
+        if self._difference(signature) <= self.threshold:
+            self.n_dropped += 1
+            return False
+
+        self._last = signature
+        self.n_kept += 1
+        return True
+
+    def reset(self):
+        """Forgets the last kept frame and the counts, i.e. for when moving on to a new video"""
+
+        self.n_kept = 0
+        self.n_dropped = 0
+        self._last = None
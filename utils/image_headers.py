@@ -0,0 +1,174 @@
+"""
+This module contains helpers for reading the dimensions of an image straight out of its file header.
+
+Decoding a full image just to find out its shape costs a read of the whole file plus a decompression.
+The width, height and number of channels of a PNG or a JPEG all live in the first few hundred bytes of
+the file, so we can read just those and never touch the pixels.
+"""
+
+import os
+import struct
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG colour type -> the number of channels that an image decodes to
+# Palette images (3) decode to RGB
+PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+# The JPEG Start Of Frame markers, which hold the dimensions. 0xC4 (DHT), 0xC8 (JPG) and 0xCC (DAC)
+# sit in the same range but are not frame headers
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# Every PNG ends with an empty IEND chunk, and every JPEG with an EOI marker
+PNG_IEND = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+JPEG_EOI = b'\xff\xd9'
+
+
+class TruncatedImageError(ValueError):
+    """Raised when a file starts out as a PNG/JPEG but ends before it should"""
+
+
+def _png_shape(f):
+    """Reads the IHDR chunk, which the PNG spec requires to be the first chunk in the file
+
+    Args:
+        f: an open file, positioned just after the 8 byte signature
+
+    Returns:
+        (rows, cols, channels), tuple of int
+    """
+
+    header = f.read(25)
+    if len(header) < 25:
+        raise TruncatedImageError('truncated PNG IHDR chunk')
+
+    if header[4:8] != b'IHDR':
+        raise ValueError('missing PNG IHDR chunk')
+
+    width, height, _, colour_type = struct.unpack('>IIBB', header[8:18])
+
+    if colour_type not in PNG_CHANNELS:
+        raise ValueError(f'unknown PNG colour type {colour_type}')
+
+    return height, width, PNG_CHANNELS[colour_type]
+
+
+def _jpeg_shape(f):
+    """Walks the JPEG markers until it finds the Start Of Frame segment
+
+    Args:
+        f: an open file, positioned just after the 2 byte SOI marker
+
+    Returns:
+        (rows, cols, channels), tuple of int
+    """
+
+    while True:
+
+        # Markers are 0xFF followed by the marker byte. Any number of 0xFF fill bytes can come first
+        byte = f.read(1)
+        while byte == b'\xff':
+            byte = f.read(1)
+
+        if not byte:
+            raise TruncatedImageError('truncated JPEG, no frame header found')
+
+        marker = byte[0]
+
+        # Standalone markers that carry no length
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue
+
+        # Start of scan or end of image before a frame header means there is nothing to find
+        if marker in (0xDA, 0xD9):
+            raise ValueError('JPEG has no frame header before its image data')
+
+        length = f.read(2)
+        if len(length) < 2:
+            raise TruncatedImageError('truncated JPEG segment')
+
+        length = struct.unpack('>H', length)[0]
+
+        if marker in JPEG_SOF_MARKERS:
+            segment = f.read(6)
+            if len(segment) < 6:
+                raise TruncatedImageError('truncated JPEG frame header')
+
+            _, height, width, channels = struct.unpack('>BHHB', segment)
+            return height, width, channels
+
+        # Skipping over the rest of the segment, its length includes the 2 length bytes themselves
+        f.seek(length - 2, 1)
+
+
+def image_shape(img_path):
+    """Reads the (rows, cols, channels) of a PNG or JPEG from its header, without decoding it
+
+    Args:
+        img_path: a full path to the image, str
+
+    Returns:
+        (rows, cols, channels), tuple of int
+
+    Raises:
+        ValueError if the file is not a PNG/JPEG or its header is broken
+    """
+
+    with open(img_path, 'rb') as f:
+
+        signature = f.read(8)
+
+        if signature == PNG_SIGNATURE:
+            return _png_shape(f)
+
+        if signature[:2] == b'\xff\xd8':
+            f.seek(2)
+            return _jpeg_shape(f)
+
+    raise ValueError(f'{img_path} is not a PNG or a JPEG')
+
+
+def validate_image(img_path):
+    """Checks that an image is a complete, 3 channel PNG or JPEG, from its header and its last few bytes
+
+    Returns one of:
+        'ok': readable, complete and with 3 (RGB) or 4 (RGBA) channels
+        'truncated': a PNG/JPEG that ends before its end marker, i.e. a copy that was cut short
+        'greyscale': a single channel image, with or without alpha
+        'cmyk': a 4 component JPEG, which most decoders will not turn into RGB for us
+        'unreadable': not a PNG/JPEG at all, a broken header, or a file that cannot be opened
+
+    Args:
+        img_path: a full path to the image, str
+
+    Returns:
+        (status, (rows, cols, channels) or None), (str, tuple)
+    """
+
+    try:
+        shape = image_shape(img_path)
+
+        # The header can be fine while the rest of the file is missing, so check that it ends properly
+        with open(img_path, 'rb') as f:
+            is_png = f.read(8) == PNG_SIGNATURE
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - 12, 0))
+            tail = f.read()
+
+    except TruncatedImageError:
+        return 'truncated', None
+
+    except (ValueError, OSError):
+        return 'unreadable', None
+
+    # JPEG writers are allowed to leave padding after the EOI marker, so only look for it near the end
+    if (is_png and not tail.endswith(PNG_IEND)) or (not is_png and JPEG_EOI not in tail):
+        return 'truncated', shape
+
+    if shape[2] in (1, 2):
+        return 'greyscale', shape
+
+    if not is_png and shape[2] == 4:
+        return 'cmyk', shape
+
+    return 'ok', shape
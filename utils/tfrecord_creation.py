@@ -1,42 +1,87 @@
 from __future__ import absolute_import, division, print_function
-import tensorflow as tf
 import numpy as np
 import os
-import matplotlib.image as mpimg
 import shutil
-from random import shuffle
+from random import Random
 import time
 import json
+import glob
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from image_headers import image_shape, validate_image
+import tfrecord_io
 
+# NOTE: TensorFlow is only imported inside of the tfrecord_extractor methods (and the reader benchmark).
+# The writers go through tfrecord_io, so the conversion workers never pay for importing it
 
-def img_cc_checker(img_folder, silent=True):
+
+def validate_images(img_folder, cache_file=None, n_threads=32):
+    '''A helper function to check every image in a folder from its header, without decoding any of them
+    Results are cached by path, modification time and size, so re-running over a folder that has not
+    changed only costs a directory listing
+    Args:
+        img_folder: a full path to the folder containing the images to scan, str
+        cache_file: where to keep the cache, defaults to <img_folder>.img_cache.json, False for no cache, str
+        n_threads: the number of images to check at once, int
+    Returns:
+        {full path: (status, (rows, cols, channels) or None)}, see image_headers.validate_image for statuses
+    '''
+    assert os.path.isdir(img_folder), 'img_folder is not real, silly'
+
+    if cache_file is None:
+        cache_file = os.path.normpath(img_folder) + '.img_cache.json'
+
+    # {path: [mtime_ns, size, status, shape]}
+    cache = {}
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+
+    # scandir hands back the stat of every file along with the listing, on Windows at no extra cost
+    stats = {entry.path: (entry.stat().st_mtime_ns, entry.stat().st_size)
+             for entry in os.scandir(img_folder) if entry.is_file()}
+
+    # Anything new, or changed since it was cached, needs checking again
+    stale = [path for path, stat in stats.items() if path not in cache or tuple(cache[path][:2]) != stat]
+    checked = _bulk_apply(validate_image, [(path,) for path in stale], n_threads)
+
+    for path, (status, shape) in zip(stale, checked):
+        cache[path] = list(stats[path]) + [status, shape]
+
+    # Dropping files that no longer exist in the folder from the cache
+    removed = len(cache) != len(stats)
+    cache = {path: cache[path] for path in stats}
+
+    if cache_file and (stale or removed):
+        with open(cache_file, 'w') as f:
+            f.write(json.dumps(cache))
+
+    return {path: (status, tuple(shape) if shape else None) for path, (_, _, status, shape) in cache.items()}
+
+
+def img_cc_checker(img_folder, silent=True, cache_file=None):
     '''A helper function to skim through a folder of images and alert the user if some images are not 3CC
     Args:
         img_folder: a full path to the folder containing the images to scan, str
         silent: make it talk, bool
+        cache_file: see validate_images(), str
     Returns:
         a list of full paths to the bad images
     '''
-    assert os.path.isdir(img_folder), 'img_folder is not real, silly'
-
-    # Init list
-    bad_imgs = []
+    results = validate_images(img_folder, cache_file=cache_file)
 
-    # Image full paths
-    img_full_paths = [os.path.join(img_folder, x)
-                      for x in [x for x in os.listdir(img_folder)]]
+    # Raising hand if the image is not a complete 3CC image (could be greyscale, truncated, etc)
+    bad_imgs = sorted(path for path, (status, _) in results.items() if status != 'ok')
 
-    # Looping through images. Raising hand if the image does not have a CC attribute (could be greyscale, etc)
-    for img in img_full_paths:
-        try:
-            mpimg.imread(img).shape[2]
-        except:
-            bad_imgs.append(img)
-            if silent == False:
-                print('We found one, boss...')
+    if silent == False:
+        counts = {}
+        for status, _ in results.values():
+            counts[status] = counts.get(status, 0) + 1
+        print(f'We found {len(bad_imgs)}, boss... {counts}')
 
     return bad_imgs
 
+
 def file_rename(top_dir, data_dir, train_pct, silent=True):
     '''A helper function that renames files in the format classname_number
     Args:
@@ -47,89 +92,149 @@ def file_rename(top_dir, data_dir, train_pct, silent=True):
     Returns:
         a class_names_to_ids dict, {class_num, 'class_str'}
     '''
-    # Creating global references
-    isdir = os.path.isdir
+    # All of the work now happens in a single pass, see prepare_dataset()
+    return prepare_dataset(top_dir=top_dir, data_dir=data_dir, train_pct=train_pct,
+                           stratify=False, silent=silent)['labels']
+
+
+def _bulk_apply(fn, args, n_threads):
+    '''A helper function to run a file system call over many paths at once. On a network share every
+    call is a round trip, so running a few dozen of them at the same time hides most of the latency
+    Args:
+        fn: the function to call, i.e. os.rename
+        args: a list of tuples of arguments, one tuple per call
+        n_threads: the number of calls to have in flight at once, int
+    Returns:
+        a list of the results, in the same order as args
+    '''
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(lambda a: fn(*a), args))
+
+
+def prepare_dataset(top_dir, data_dir, train_pct, stratify=True, seed=None, n_threads=32,
+                    dry_run=False, manifest_file=None, silent=True):
+    '''Turns a folder of class folders into data_dir/train and data_dir/test, with every image renamed
+    to classname__number, in a single pass:
+        1. every class folder is listed exactly once, with os.scandir
+        2. every image is validated from its header (not decoded), in a thread pool
+        3. the train/test split is drawn from sets, per class if stratify
+        4. every image is moved straight to its final home, in a thread pool
+    Images that fail validation (greyscale, CMYK, truncated or unreadable) are deleted.
+    Args:
+        top_dir: path to the folder that contains the folders of the classes that contain the image data, str
+        data_dir: path to the ultimate folder that will contain our renamed data, str
+        train_pct: the percentage of the data to use as the training set, float
+        stratify: split each class separately, so that train and test have the same class balance, bool
+        seed: seeds the split, int
+        n_threads: the number of file system calls to have in flight at once, int
+        dry_run: work everything out and return the manifest, but do not touch any files, bool
+        manifest_file: where to save the manifest as json, None to not save it, str
+        silent: a switch to control the output of information
+    Returns:
+        the manifest: {'labels': {class: id}, 'train': [(src, dst)], 'test': [(src, dst)],
+                       'bad': [src], 'timing': {stage: seconds}}
+    '''
     pathjoin = os.path.join
-    listdir = os.listdir
-    rename = os.rename
-    rmdir = os.rmdir
-    # Creating the data folder if it does not already exist
-    if not isdir(data_dir):
-        os.mkdir(data_dir)
-
-    # This is to report on how long it took this action to complete
-    start = time.time()
+    timing = {}
+    rng = Random(seed)
+
+    # == 1. Scanning == #
+    tic = time.time()
 
-    # == Getting the full paths to each of our image classes ==#
-    # A list for the class names
-    class_names = listdir(top_dir)
+    # The ids follow the listing order, as file_rename always numbered them, so existing label maps stay valid
+    class_dirs = [entry for entry in os.scandir(top_dir) if entry.is_dir()]
+    class_names_to_ids = {entry.name: i for i, entry in enumerate(class_dirs)}
 
-    # Creating a dict to return of this list
-    class_names_to_ids = dict(zip(class_names, range(len(class_names))))
+    # {class name: [(src, renamed file name)]}, numbered in listing order as file_rename always did
+    files = {}
+    for entry in class_dirs:
+        files[entry.name] = [(img.path, entry.name + '__' + str(z) + '.jpg')
+                             for z, img in enumerate(e for e in os.scandir(entry.path) if e.is_file())]
 
-    # Full paths to the folders
-    class_path = [pathjoin(top_dir, folder) for folder in class_names]
+    timing['scan'] = time.time() - tic
 
-    # Looping through each class_path
-    for i in range(len(class_path)):
+    # == 2. Validating == #
+    tic = time.time()
 
-        # Getting a list of the files in each class_path
-        ll = [pathjoin(class_path[i], file) for file in listdir(class_path[i])]
+    all_files = [f for class_files in files.values() for f in class_files]
+    checked = _bulk_apply(validate_image, [(src,) for src, _ in all_files], n_threads)
+    bad = set(src for (src, _), (status, _) in zip(all_files, checked) if status != 'ok')
 
-        # Looping through filenames and renaming them to the data_dir
-        for z in range(len(ll)):
-            rename(src=ll[z],
-                   dst=pathjoin(data_dir,
-                                class_names[i] + '__' + str(z) + '.jpg'))
+    timing['validate'] = time.time() - tic
 
-    # Deleting images that are not 3cc before we create the train/test folders
-    bad_imgs = img_cc_checker(img_folder=data_dir)
-    for img in bad_imgs:
-        os.remove(img)
+    # == 3. Splitting == #
+    tic = time.time()
 
-    # Geting a list of the file names in data to be shuffled
-    data_files = [x for x in listdir(data_dir)]
-    shuffle(data_files)
-    data_files_train = data_files[:int(np.round(len(data_files) * train_pct))]
-    data_files_test = [x for x in data_files if x not in data_files_train]
+    groups = list(files.values()) if stratify else [all_files]
+    train, test = [], []
+    for group in groups:
+        good = [f for f in group if f[0] not in bad]
+        rng.shuffle(good)
+        n_train = int(np.round(len(good) * train_pct))
+        train += [(src, pathjoin(data_dir, 'train', name)) for src, name in good[:n_train]]
+        test += [(src, pathjoin(data_dir, 'test', name)) for src, name in good[n_train:]]
 
-    # Now creating a new folder for train. Need to do this after so there
-    # Are no conflicts with moving folders into each other
-    if not isdir(pathjoin(data_dir, 'train')):
-        os.mkdir(pathjoin(data_dir, 'train'))
-    if not isdir(pathjoin(data_dir, 'test')):
-        os.mkdir(pathjoin(data_dir, 'test'))
+    timing['split'] = time.time() - tic
 
+    manifest = {'labels': class_names_to_ids, 'train': train, 'test': test, 'bad': sorted(bad), 'timing': timing}
 
+    # == 4. Moving == #
+    tic = time.time()
 
-    # Now moving files into the train/test folders
-    for train_file in data_files_train:
-        rename(src=pathjoin(data_dir, train_file),
-               dst=pathjoin(data_dir, 'train', train_file))
+    if not dry_run:
+        for folder in [data_dir, pathjoin(data_dir, 'train'), pathjoin(data_dir, 'test')]:
+            if not os.path.isdir(folder):
+                os.mkdir(folder)
 
-    for test_file in data_files_test:
-        rename(src=pathjoin(data_dir, test_file),
-               dst=pathjoin(data_dir, 'test', test_file))
+        _bulk_apply(os.rename, train + test, n_threads)
+        _bulk_apply(os.remove, [(src,) for src in bad], n_threads)
 
-    # Deleting the old shell folders
-    for folder in listdir(top_dir):
-        rmdir(pathjoin(top_dir, folder))
+        # Deleting the old shell folders
+        for entry in class_dirs:
+            os.rmdir(entry.path)
 
-    # Writing the labels dictionary to a .txt file
-    with open(pathjoin(data_dir, 'labels.txt'), 'w') as f:
-        f.write(json.dumps(class_names_to_ids))
+        # Writing the labels dictionary to a .txt file
+        with open(pathjoin(data_dir, 'labels.txt'), 'w') as f:
+            f.write(json.dumps(class_names_to_ids))
+
+    timing['move'] = time.time() - tic
+
+    if manifest_file is not None:
+        with open(manifest_file, 'w') as f:
+            f.write(json.dumps(manifest))
 
     if silent == False:
         # Message of doneness
-        img_len = len(data_files)
-        train_len = len(listdir(pathjoin(data_dir, 'train')))
-        test_len = len(listdir(pathjoin(data_dir, 'test')))
-        full_time = time.time() - start
-        print(f'Rename complete. You renamed {img_len} images. This action took {full_time} seconds.')
-        print(f'\n Your training folder contains {train_len} images. \n Your testing folder contains {test_len} images.')
-        return class_names_to_ids
-    else:
-        return class_names_to_ids
+        action = 'Planned' if dry_run else 'Prepared'
+        print(f'{action} {len(all_files)} images in {sum(timing.values())} seconds '
+              f'({", ".join(f"{stage}: {seconds:.2f}s" for stage, seconds in timing.items())}).')
+        print(f'\n Your training folder contains {len(train)} images. \n Your testing folder contains {len(test)} images.'
+              f'\n {len(bad)} images were not 3CC and {"would be" if dry_run else "were"} removed.')
+
+    return manifest
+
+
+def _balance_shards(sizes, n_shards):
+    '''A helper function that splits files into n_shards groups of (roughly) equal total size
+    Args:
+        sizes: the size of each file to split up, {full path: bytes}
+        n_shards: the number of groups to split the files into, int
+    Returns:
+        a list of n_shards lists of full paths
+    '''
+    # Greedy "largest first" bin packing: every file goes to whichever shard is currently the lightest.
+    # Far from optimal in theory, but with thousands of small files per shard the totals end up within
+    # a file or so of each other, which is all that we need for the readers to stay in lockstep
+    shards = [[] for _ in range(n_shards)]
+    totals = [0] * n_shards
+
+    for path in sorted(sizes, key=sizes.get, reverse=True):
+        lightest = totals.index(min(totals))
+        shards[lightest].append(path)
+        totals[lightest] += sizes[path]
+
+    return shards
+
 
 class tfrecord_generator():
     def __init__(self, labels):
@@ -140,28 +245,121 @@ class tfrecord_generator():
         img_paths = os.listdir(img_folder)
         img_paths = [os.path.abspath(os.path.join(img_folder, i)) for i in img_paths]
 
-        with tf.python_io.TFRecordWriter(tfrecord_file_name) as writer:
+        with tfrecord_io.TFRecordWriter(tfrecord_file_name) as writer:
+            for img_path in img_paths:
+                writer.write(self._convert_image(img_path))
+
+    def convert_image_folder_sharded(self, img_folder, tfrecord_prefix, n_shards=64, n_workers=None, seed=None):
+        '''Converts a folder of images into n_shards .tfrecord files, written in parallel
+        Args:
+            img_folder: a full path to the folder containing the images, str
+            tfrecord_prefix: the shards are written to <tfrecord_prefix>-00000-of-00064 and so on, str
+            n_shards: the number of shards to write, int
+            n_workers: the number of processes to write with, defaults to the number of cores, int
+            seed: seeds the shuffle of the images within each shard, int
+        Returns:
+            a list of the full paths to the shards
+        '''
+        assert os.path.isdir(img_folder), 'img_folder is not real, silly'
+
+        start = time.time()
+
+        # On Windows shares scandir() hands back the file sizes with the listing, so this is a single sweep
+        sizes = {entry.path: entry.stat().st_size for entry in os.scandir(img_folder) if entry.is_file()}
+        shards = _balance_shards(sizes, n_shards)
+
+        shard_files = [f'{tfrecord_prefix}-{i:05d}-of-{n_shards:05d}' for i in range(n_shards)]
+
+        # Each worker owns its shards from start to finish, so there is nothing to coordinate between them
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            counts = list(executor.map(self._write_shard,
+                                       shards,
+                                       shard_files,
+                                       [None if seed is None else seed + i for i in range(n_shards)]))
+
+        print(f'Wrote {sum(counts)} images into {n_shards} shards in {time.time() - start} seconds.')
+
+        return shard_files
+
+    def convert_labeled_images_sharded(self, img_folder, img_labels, tfrecord_prefix, n_shards=16, n_workers=None,
+                                       seed=None):
+        '''Like .convert_image_folder_sharded(), but for images whose labels come from somewhere other than
+        their filenames, i.e. the label records of the labeling app. Images without a label are skipped
+        Args:
+            img_folder: a full path to the folder containing the images, str
+            img_labels: {filename: class name}, where every class name is a key of self.labels, dict
+            tfrecord_prefix: the shards are written to <tfrecord_prefix>-00000-of-00016 and so on, str
+            n_shards: the number of shards to write, int
+            n_workers: the number of processes to write with, defaults to the number of cores, int
+            seed: seeds the shuffle of the images within each shard, int
+        Returns:
+            a list of the full paths to the shards
+        '''
+        assert os.path.isdir(img_folder), 'img_folder is not real, silly'
+
+        start = time.time()
+
+        # One sweep of the folder for the sizes of the labeled images, rather than a stat() per label
+        sizes = {entry.path: entry.stat().st_size for entry in os.scandir(img_folder)
+                 if entry.name in img_labels and entry.is_file()}
+        shards = _balance_shards(sizes, n_shards)
+
+        shard_files = [f'{tfrecord_prefix}-{i:05d}-of-{n_shards:05d}' for i in range(n_shards)]
+
+        # Each worker only gets the labels of its own shard
+        shard_labels = [{path: img_labels[os.path.basename(path)] for path in shard} for shard in shards]
+
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            counts = list(executor.map(self._write_shard,
+                                       shards,
+                                       shard_files,
+                                       [None if seed is None else seed + i for i in range(n_shards)],
+                                       shard_labels))
+
+        print(f'Wrote {sum(counts)} images into {n_shards} shards in {time.time() - start} seconds.')
+
+        return shard_files
+
+    def _write_shard(self, img_paths, tfrecord_file_name, seed=None, img_labels=None):
+        '''Writes a single shard. This is what the .convert_image_folder_sharded() workers run
+        Args:
+            img_paths: full paths to the images that belong in this shard, list
+            tfrecord_file_name: the shard to write, str
+            seed: seeds the shuffle of the images within the shard, int
+            img_labels: {full path: class name}, the labels are taken from the filenames if not given, dict
+        Returns:
+            the number of images written, int
+        '''
+        # The images get handed out by size, so we shuffle them to not end up with a shard that runs
+        # from the biggest image to the smallest
+        img_paths = list(img_paths)
+        Random(seed).shuffle(img_paths)
+
+        with tfrecord_io.TFRecordWriter(tfrecord_file_name) as writer:
             for img_path in img_paths:
-                example = self._convert_image(img_path)
-                writer.write(example.SerializeToString())
+                writer.write(self._convert_image(img_path, None if img_labels is None else img_labels[img_path]))
 
-    def _convert_image(self, img_path):
-        label = self._get_label_with_filename(img_path)
-        img_shape = mpimg.imread(img_path).shape
+        return len(img_paths)
+
+    def _convert_image(self, img_path, class_name=None):
+        label = self._get_label_with_filename(img_path) if class_name is None else self.labels[class_name]
+        # Only the header of the image is read to get its shape, the pixels are never decoded
+        img_shape = image_shape(img_path)
         filename = os.path.basename(img_path)
 
         # Read image data in terms of bytes
-        with tf.gfile.FastGFile(img_path, 'rb') as fid:
+        with open(img_path, 'rb') as fid:
             image_data = fid.read()
 
-        example = tf.train.Example(features=tf.train.Features(feature={
-            'filename': tf.train.Feature(bytes_list=tf.train.BytesList(value=[filename.encode('utf-8')])),
-            'rows': tf.train.Feature(int64_list=tf.train.Int64List(value=[img_shape[0]])),
-            'cols': tf.train.Feature(int64_list=tf.train.Int64List(value=[img_shape[1]])),
-            'channels': tf.train.Feature(int64_list=tf.train.Int64List(value=[img_shape[2]])),
-            'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image_data])),
-            'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
-        }))
+        # A serialized tf.train.Example, identical to what TensorFlow itself would write
+        example = tfrecord_io.encode_example({
+            'filename': filename,
+            'rows': img_shape[0],
+            'cols': img_shape[1],
+            'channels': img_shape[2],
+            'image': image_data,
+            'label': label,
+        })
         return example
 
     def _get_label_with_filename(self, filename):
@@ -172,11 +370,18 @@ class tfrecord_generator():
 
 class tfrecord_extractor():
     def __init__(self, tfrecord_file):
-        self.tfrecord_file = os.path.abspath(tfrecord_file)
+        # tfrecord_file can be a single file, a glob pattern (i.e. '.../train-*-of-00064') or a list of files
+        if isinstance(tfrecord_file, str):
+            tfrecord_file = sorted(glob.glob(tfrecord_file)) or [tfrecord_file]
+
+        self.tfrecord_files = [os.path.abspath(f) for f in tfrecord_file]
+        self.tfrecord_file = self.tfrecord_files[0]
+
+    def _features(self):
+        import tensorflow as tf
 
-    def _extract_fn(self, tfrecord):
         # Extract features using the keys set during creation
-        features = {
+        return {
             'filename': tf.FixedLenFeature([], tf.string),
             'rows': tf.FixedLenFeature([], tf.int64),
             'cols': tf.FixedLenFeature([], tf.int64),
@@ -185,8 +390,11 @@ class tfrecord_extractor():
             'label': tf.FixedLenFeature([], tf.int64)
         }
 
+    def _extract_fn(self, tfrecord):
+        import tensorflow as tf
+
         # Extract the data record
-        sample = tf.parse_single_example(tfrecord, features)
+        sample = tf.parse_single_example(tfrecord, self._features())
 
         image = tf.image.decode_image(sample['image'])
         img_shape = tf.stack([sample['rows'], sample['cols'], sample['channels']])
@@ -195,6 +403,8 @@ class tfrecord_extractor():
         return [image, label, filename, img_shape]
 
     def extract_image(self):
+        import tensorflow as tf
+
         # Create folder to store extracted images
         folder_path = './ExtractedImages'
         shutil.rmtree(folder_path, ignore_errors=True)
@@ -212,15 +422,180 @@ class tfrecord_extractor():
             image_data = sess.run(next_image_data)
             return image_data
 
+    def read_examples(self, check_crc=False):
+        '''Reads every example out of every shard without TensorFlow (see tfrecord_io)
+        Args:
+            check_crc: verify the checksums of every record, bool
+        Returns:
+            yields {'filename': [bytes], 'rows': [int], ..., 'label': [int]}, dict
+        '''
+        for tfrecord_file in self.tfrecord_files:
+            for example in tfrecord_io.read_examples(tfrecord_file, check_crc=check_crc):
+                yield example
+
+    def _batch_extract_fn(self, image_size):
+        '''Builds the parsing function for .dataset(). Every example in a batch needs the same shape, so
+        the images are either resized to image_size or left as their encoded bytes
+        Args:
+            image_size: (rows, cols) to decode and resize to, None to skip decoding, tuple
+        Returns:
+            a function mapping a serialized example to [image, label, filename, img_shape]
+        '''
+        import tensorflow as tf
+
+        def extract_fn(tfrecord):
+            sample = tf.parse_single_example(tfrecord, self._features())
+
+            image = sample['image']
+            if image_size is not None:
+                # decode_image does not know its rank (GIFs are 4D), so we have to tell it before resizing
+                image = tf.image.decode_image(image, channels=3)
+                image.set_shape([None, None, 3])
+                image = tf.image.resize_images(image, image_size)
+
+            img_shape = tf.stack([sample['rows'], sample['cols'], sample['channels']])
+            return [image, sample['label'], sample['filename'], img_shape]
+
+        return extract_fn
+
+    def dataset(self, batch_size=32, image_size=None, shuffle_buffer=0, cache=False, repeat=False,
+                cycle_length=None, num_parallel_calls=None, seed=None):
+        '''Builds a tf.data pipeline that reads all of the shards at once
+        Args:
+            batch_size: the number of examples per batch, int
+            image_size: (rows, cols) to decode and resize the images to, None to return the encoded bytes, tuple
+            shuffle_buffer: the number of examples to shuffle across, 0 to not shuffle, int
+            cache: cache the parsed examples in memory (True) or to a file (str) after the first pass, bool/str
+            repeat: loop over the data forever, bool
+            cycle_length: the number of shards to read from at the same time, defaults to all of them, int
+            num_parallel_calls: the number of examples to parse at the same time, defaults to autotuning, int
+            seed: seeds the order of the shards and the shuffle buffer, int
+        Returns:
+            a tf.data.Dataset of [image, label, filename, img_shape] batches
+        '''
+        import tensorflow as tf
+
+        autotune = tf.data.experimental.AUTOTUNE
+
+        # Reading many shards at once, interleaved, keeps any single file's I/O from being the bottleneck
+        files = tf.data.Dataset.from_tensor_slices(self.tfrecord_files)
+        if shuffle_buffer > 0:
+            files = files.shuffle(len(self.tfrecord_files), seed=seed)
+
+        dataset = files.interleave(tf.data.TFRecordDataset,
+                                   cycle_length=cycle_length or len(self.tfrecord_files),
+                                   num_parallel_calls=autotune)
+
+        dataset = dataset.map(self._batch_extract_fn(image_size),
+                              num_parallel_calls=num_parallel_calls or autotune)
+
+        # Caching after the parse means later epochs skip both the I/O and the decode
+        if cache:
+            dataset = dataset.cache(cache if isinstance(cache, str) else '')
+
+        if shuffle_buffer > 0:
+            dataset = dataset.shuffle(shuffle_buffer, seed=seed)
+
+        if repeat:
+            dataset = dataset.repeat()
+
+        # Prefetching lets the next batch get prepared while the current one is being used
+        return dataset.batch(batch_size).prefetch(autotune)
+
+    def iterate_batches(self, **kwargs):
+        '''Runs .dataset() and yields its batches as NumPy arrays
+        Args:
+            **kwargs: passed straight through to .dataset()
+        Returns:
+            yields [image, label, filename, img_shape] batches, list of np.array
+        '''
+        import tensorflow as tf
+
+        next_batch = self.dataset(**kwargs).make_one_shot_iterator().get_next()
+
+        with tf.Session() as sess:
+            while True:
+                try:
+                    yield sess.run(next_batch)
+                except tf.errors.OutOfRangeError:
+                    return
+
+
+def benchmark_reader(n_shards=8, n_examples=4096, img_size=(224, 224), batch_size=64, folder=None):
+    '''Writes a set of synthetic shards and compares how quickly they can be read one example at a
+    time (the old .extract_image() approach) versus through tfrecord_extractor.dataset()
+    Args:
+        n_shards: the number of shards to write, int
+        n_examples: the total number of examples across all of the shards, int
+        img_size: the (rows, cols) of the synthetic JPEGs, tuple
+        batch_size: the batch size for the pipelined reader, int
+        folder: where to write the shards, defaults to a temporary folder, str
+    Returns:
+        {reader: examples per second}
+    '''
+    import tensorflow as tf
+
+    folder = folder or tempfile.mkdtemp()
+
+    # One random JPEG is plenty, the readers never look at what is in the pixels
+    with tf.Session() as sess:
+        pixels = np.random.randint(0, 256, size=img_size + (3,), dtype=np.uint8)
+        image_data = sess.run(tf.image.encode_jpeg(pixels))
+
+    example = tfrecord_io.encode_example({
+        'filename': 'synthetic.jpg',
+        'rows': img_size[0],
+        'cols': img_size[1],
+        'channels': 3,
+        'image': image_data,
+        'label': 0,
+    })
+
+    shard_files = [os.path.join(folder, f'synthetic-{i:05d}-of-{n_shards:05d}') for i in range(n_shards)]
+    for shard_file in shard_files:
+        with tfrecord_io.TFRecordWriter(shard_file) as writer:
+            for _ in range(n_examples // n_shards):
+                writer.write(example)
+
+    extractor = tfrecord_extractor(shard_files)
+    results = {}
+
+    # Serial: one file after the other, one example per session call, decoded one at a time
+    start = time.time()
+    next_image_data = tf.data.TFRecordDataset(shard_files).map(extractor._extract_fn).make_one_shot_iterator().get_next()
+    count = 0
+    with tf.Session() as sess:
+        while True:
+            try:
+                sess.run(next_image_data)
+                count += 1
+            except tf.errors.OutOfRangeError:
+                break
+    results['serial'] = count / (time.time() - start)
+
+    # Pipelined: interleaved shards, parallel parsing, batched and prefetched
+    start = time.time()
+    count = sum(len(batch[1]) for batch in extractor.iterate_batches(batch_size=batch_size, image_size=img_size))
+    results['pipelined'] = count / (time.time() - start)
+
+    print(f'serial: {results["serial"]:.1f} examples/s')
+    print(f'pipelined: {results["pipelined"]:.1f} examples/s ({results["pipelined"] / results["serial"]:.2f}x)')
+
+    return results
+
 
-top_dir = '//10.176.176.135/qdr_synapse/data/food-101/images'
-data_dir = '//10.176.176.135/qdr_synapse/data/food-101/data'
+# The worker processes re-import this module, so the driver has to live under the __main__ guard
+if __name__ == '__main__':
+    top_dir = '//10.176.176.135/qdr_synapse/data/food-101/images'
+    data_dir = '//10.176.176.135/qdr_synapse/data/food-101/data'
 
-class_dict = file_rename(top_dir=top_dir, data_dir=data_dir, train_pct=.8, silent=False)
+    class_dict = file_rename(top_dir=top_dir, data_dir=data_dir, train_pct=.8, silent=False)
 
-t = tfrecord_generator(labels=class_dict)
-t.convert_image_folder(img_folder='//10.176.176.135/qdr_synapse/data/food-101/data/train',
-                       tfrecord_file_name='//10.176.176.135/qdr_synapse/data/food-101/data/train.tfrecord')
-t.convert_image_folder(img_folder='//10.176.176.135/qdr_synapse/data/food-101/data/test',
-                       tfrecord_file_name='//10.176.176.135/qdr_synapse/data/food-101/data/test.tfrecord')
+    t = tfrecord_generator(labels=class_dict)
+    t.convert_image_folder_sharded(img_folder='//10.176.176.135/qdr_synapse/data/food-101/data/train',
+                                   tfrecord_prefix='//10.176.176.135/qdr_synapse/data/food-101/data/train',
+                                   n_shards=64)
+    t.convert_image_folder_sharded(img_folder='//10.176.176.135/qdr_synapse/data/food-101/data/test',
+                                   tfrecord_prefix='//10.176.176.135/qdr_synapse/data/food-101/data/test',
+                                   n_shards=16)
 
@@ -0,0 +1,342 @@
+"""
+This module contains a TensorFlow-free reader and writer for .tfrecord files.
+
+A .tfrecord file is nothing more than a sequence of records, each one framed as:
+    uint64 length | uint32 masked crc32c of length | length bytes of data | uint32 masked crc32c of data
+and, for our purposes, the data is a serialized tf.train.Example protobuf. Both of those are simple
+enough to read and write by hand, which saves the conversion workers the seconds of startup and the
+hundreds of MB of memory that come with importing TensorFlow just to use TFRecordWriter.
+
+CRC32C is computed with the `crc32c` package if it is installed (it is written in C). Otherwise a pure
+Python table is used, which is correct but slow, so install the package on the conversion boxes.
+"""
+
+import mmap
+import numbers
+import os
+import struct
+
+try:
+    from crc32c import crc32c as _crc32c_update
+except ImportError:
+    _crc32c_update = None
+
+
+# === CRC32C === #
+
+def _make_crc32c_table():
+    '''Builds the lookup table for the (reflected) Castagnoli polynomial'''
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def crc32c(data):
+    '''The CRC32C (Castagnoli) checksum of some data
+    Args:
+        data: bytes-like
+    Returns:
+        the checksum, int
+    '''
+    if _crc32c_update is not None:
+        return _crc32c_update(data)
+
+    table = _CRC32C_TABLE
+    crc = 0xFFFFFFFF
+    for byte in bytes(data):
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data):
+    '''TFRecords store a rotated and offset crc, so that a crc of data that itself contains crcs is
+    not trivially predictable
+    Args:
+        data: bytes-like
+    Returns:
+        the masked checksum, int
+    '''
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+# === Record framing === #
+
+class TFRecordWriter():
+    '''A drop in for tf.python_io.TFRecordWriter (uncompressed only), usable as a context manager'''
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+
+    def write(self, record):
+        length = struct.pack('<Q', len(record))
+        self.f.write(length)
+        self.f.write(struct.pack('<I', masked_crc32c(length)))
+        self.f.write(record)
+        self.f.write(struct.pack('<I', masked_crc32c(record)))
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_records(path, check_crc=False):
+    '''Memory-maps a .tfrecord file and yields its records without reading the whole file into memory
+    Args:
+        path: a full path to the .tfrecord file, str
+        check_crc: verify the checksums of every record (slow without the crc32c package), bool
+    Returns:
+        yields each record, memoryview. The views are only valid until the next record is asked for
+    '''
+    # mmap refuses to map an empty file
+    if os.path.getsize(path) == 0:
+        return
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        offset = 0
+        try:
+            while offset < len(mm):
+                if offset + 12 > len(mm):
+                    raise IOError(f'{path} is truncated at byte {offset}')
+
+                length, length_crc = struct.unpack_from('<QI', mm, offset)
+                start = offset + 12
+                end = start + length
+
+                if end + 4 > len(mm):
+                    raise IOError(f'{path} is truncated at byte {offset}')
+
+                if check_crc:
+                    data_crc = struct.unpack_from('<I', mm, end)[0]
+                    if masked_crc32c(view[offset:offset + 8]) != length_crc or masked_crc32c(view[start:end]) != data_crc:
+                        raise IOError(f'{path} has a corrupt record at byte {offset}')
+
+                record = view[start:end]
+                try:
+                    yield record
+                finally:
+                    record.release()
+
+                offset = end + 4
+        finally:
+            view.release()
+
+
+# === tf.train.Example encoding === #
+
+def _varint(value):
+    '''Protobuf base 128 varint. Negative int64s are written as their 10 byte two's complement'''
+    value &= 0xFFFFFFFFFFFFFFFF
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _length_delimited(field, payload):
+    '''A length delimited (wire type 2) protobuf field'''
+    return _varint((field << 3) | 2) + _varint(len(payload)) + payload
+
+
+def _encode_feature(values):
+    '''Encodes a tf.train.Feature. Lists of bytes/str become a BytesList, lists of ints an Int64List and lists
+    of floats a FloatList. NumPy scalars count as the Python type that they stand for (numbers.Integral and
+    numbers.Real cover np.integer and np.floating), anything else raises a TypeError'''
+    if not isinstance(values, (list, tuple)):
+        values = [values]
+
+    if all(isinstance(v, numbers.Integral) for v in values):
+        # Int64List.value is packed, so it is one length delimited field of back to back varints
+        packed = b''.join(_varint(int(v)) for v in values)
+        int64_list = _length_delimited(1, packed) if values else b''
+        return _length_delimited(3, int64_list)
+
+    if all(isinstance(v, numbers.Real) for v in values):
+        # FloatList.value is packed too, as back to back little endian float32s
+        float_list = _length_delimited(1, struct.pack(f'<{len(values)}f', *(float(v) for v in values)))
+        return _length_delimited(2, float_list)
+
+    # bytes() of an int (or of a NumPy scalar) is a buffer of that many zeros, so only bytes-likes get through
+    for v in values:
+        if not isinstance(v, (str, bytes, bytearray, memoryview)):
+            raise TypeError(f'cannot encode a {type(v).__name__} into a tf.train.Feature, '
+                            f'expected int, float, str or bytes')
+
+    bytes_list = b''.join(_length_delimited(1, v.encode('utf-8') if isinstance(v, str) else bytes(v))
+                          for v in values)
+    return _length_delimited(1, bytes_list)
+
+
+def encode_example(features):
+    '''Serializes a tf.train.Example, byte for byte what TensorFlow writes with deterministic=True
+    (map entries sorted by key)
+    Args:
+        features: {name: int, float, bytes, str or a list of them}, dict
+    Returns:
+        the serialized Example, bytes
+    '''
+    entries = b''.join(_length_delimited(1, _length_delimited(1, name.encode('utf-8')) +
+                                            _length_delimited(2, _encode_feature(features[name])))
+                       for name in sorted(features))
+    return _length_delimited(1, entries)
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _iter_fields(buf, start, end):
+    '''Walks the fields of a protobuf message in buf[start:end]
+    Returns:
+        yields (field number, wire type, value or (start, end) of the payload for wire type 2)
+    '''
+    pos = start
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+            yield field, wire_type, value
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            yield field, wire_type, (pos, pos + length)
+            pos += length
+        elif wire_type == 5:
+            yield field, wire_type, (pos, pos + 4)
+            pos += 4
+        elif wire_type == 1:
+            yield field, wire_type, (pos, pos + 8)
+            pos += 8
+        else:
+            raise ValueError(f'unsupported protobuf wire type {wire_type}')
+
+
+def _signed(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _decode_feature(buf, start, end):
+    for kind, _, (list_start, list_end) in _iter_fields(buf, start, end):
+        values = []
+        for _, wire_type, value in _iter_fields(buf, list_start, list_end):
+            if kind == 1:
+                values.append(bytes(buf[value[0]:value[1]]))
+            elif kind == 2:
+                # Floats come packed (wire type 2) or, from older writers, one by one (wire type 5)
+                values.extend(struct.unpack(f'<{(value[1] - value[0]) // 4}f', buf[value[0]:value[1]]))
+            elif wire_type == 0:
+                values.append(_signed(value))
+            else:
+                pos = value[0]
+                while pos < value[1]:
+                    v, pos = _read_varint(buf, pos)
+                    values.append(_signed(v))
+        return values
+    return []
+
+
+def decode_example(record):
+    '''Parses a serialized tf.train.Example
+    Args:
+        record: the serialized Example, bytes-like
+    Returns:
+        {name: list of values}, with bytes for a BytesList, floats for a FloatList and ints for an Int64List
+    '''
+    buf = memoryview(record)
+    example = {}
+    for _, _, (features_start, features_end) in _iter_fields(buf, 0, len(buf)):
+        for _, _, (entry_start, entry_end) in _iter_fields(buf, features_start, features_end):
+            name, feature = None, []
+            for field, _, (start, end) in _iter_fields(buf, entry_start, entry_end):
+                if field == 1:
+                    name = bytes(buf[start:end]).decode('utf-8')
+                else:
+                    feature = _decode_feature(buf, start, end)
+            example[name] = feature
+    return example
+
+
+def read_examples(path, check_crc=False):
+    '''Reads every tf.train.Example out of a .tfrecord file
+    Args:
+        path: a full path to the .tfrecord file, str
+        check_crc: verify the checksums of every record, bool
+    Returns:
+        yields {name: list of values}, dict
+    '''
+    for record in read_records(path, check_crc=check_crc):
+        yield decode_example(record)
+
+
+def verify_tensorflow_compatibility(img_paths, path_prefix):
+    '''Checks that this module and TensorFlow agree, byte for byte, on the images in img_paths.
+    This is the one place in this module that imports TensorFlow
+    Args:
+        img_paths: full paths to some images to test with, list
+        path_prefix: the two test files are written to <path_prefix>.tf and <path_prefix>.py, str
+    Returns:
+        True if the files are identical and both can be read back by the other side, bool
+    '''
+    import tensorflow as tf
+
+    features = [{'filename': os.path.basename(img_path),
+                 'label': i,
+                 'image': open(img_path, 'rb').read()}
+                for i, img_path in enumerate(img_paths)]
+
+    # Written by TensorFlow
+    with tf.python_io.TFRecordWriter(path_prefix + '.tf') as writer:
+        for feature in features:
+            example = tf.train.Example(features=tf.train.Features(feature={
+                'filename': tf.train.Feature(bytes_list=tf.train.BytesList(value=[feature['filename'].encode('utf-8')])),
+                'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[feature['label']])),
+                'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[feature['image']])),
+            }))
+            writer.write(example.SerializeToString(deterministic=True))
+
+    # Written by us
+    with TFRecordWriter(path_prefix + '.py') as writer:
+        for feature in features:
+            writer.write(encode_example(feature))
+
+    with open(path_prefix + '.tf', 'rb') as f_tf, open(path_prefix + '.py', 'rb') as f_py:
+        identical = f_tf.read() == f_py.read()
+
+    # TensorFlow reading our file...
+    tf_read = [tf.train.Example.FromString(record)
+               for record in tf.python_io.tf_record_iterator(path_prefix + '.py')]
+    tf_ok = [(e.features.feature['filename'].bytes_list.value[0],
+              e.features.feature['label'].int64_list.value[0]) for e in tf_read] == \
+            [(f['filename'].encode('utf-8'), f['label']) for f in features]
+
+    # ...and us reading TensorFlow's
+    py_ok = [(e['filename'][0], e['label'][0], e['image'][0])
+             for e in read_examples(path_prefix + '.tf', check_crc=True)] == \
+            [(f['filename'].encode('utf-8'), f['label'], f['image']) for f in features]
+
+    print(f'identical bytes: {identical}, TensorFlow reads ours: {tf_ok}, we read TensorFlow\'s: {py_ok}')
+
+    return identical and tf_ok and py_ok
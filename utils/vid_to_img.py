@@ -11,8 +11,13 @@ import time
 import cv2
 import os
 import multiprocessing
-import random
+import multiprocessing.connection
 import argparse
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from frame_filter import FrameFilter
 ### === TESTING OUT CV2 === ###
 
 # Length = 00:12:50
@@ -34,20 +39,60 @@ class Vid_To_Img:
     Once the class has been initalized for a given video, the .parallel_parse() method can be called.
     This method spawns a parallel process of the .single_parse() method
 
+    For long videos, .managed_parse() is the better option. Instead of n_parallel large segments, the
+    video is cut into many chunk_size-frame chunks that a fixed pool of n_parallel workers pulls from,
+    so a slow worker never holds up the whole job, and chunks that fail are retried. Finished chunks are
+    recorded in a manifest next to the images, so a run that dies part way through can simply be re-run
+    and will pick up where it left off.
+
+    Frames are always saved as <video_id>_<frame number>.png, so re-parsing a video overwrites the same
+    files rather than piling up copies, and many videos can share a single save_folder.
+
     """
 
     def __init__(self,
                  video_file,
                  n_parallel,
                  nth_frame,
-                 save_folder):
+                 save_folder,
+                 decode_mode='sequential',
+                 chunk_size=600,
+                 max_retries=2,
+                 interactive=True,
+                 dedup=None,
+                 dedup_threshold=None,
+                 video_id=None):
+
+        assert dedup in [None, 'dhash', 'hist'], 'dedup must be one of: None, dhash, hist'
+
+        assert decode_mode in ['sequential', 'seek'], 'decode_mode must be one of: sequential, seek'
 
         self.video_file = video_file
         self.video_len = None
         self.n_parallel = n_parallel
         self.nth_frame = nth_frame
         self.save_folder = save_folder
+        self.decode_mode = decode_mode
+        self.max_retries = max_retries
+        self.interactive = interactive
+        self.dedup = dedup
+        self.dedup_threshold = dedup_threshold
         self.job_dict  = {}
+        self.chunks = []
+
+        # By default the id of the video is its file name, minus the extension and any spaces, plus a short hash
+        # of its full path, so that two videos with the same name in different folders can share a save_folder
+        if video_id is None:
+            path_hash = hashlib.sha1(os.path.abspath(video_file).encode('utf-8')).hexdigest()[:8]
+            video_id = os.path.splitext(os.path.basename(video_file))[0].replace(' ', '_') + '_' + path_hash
+        self.video_id = video_id
+
+        # Benchmarking runs without a save_folder or an nth_frame, and needs neither the manifest nor the chunks
+        self.manifest_file = None if save_folder is None else os.path.join(save_folder, video_id + '.manifest.json')
+
+        # Every chunk has to start on a multiple of nth_frame, otherwise each chunk would restart the
+        # every-nth-frame count from its own first frame and we would drift off of the global grid
+        self.chunk_size = chunk_size if nth_frame is None else int(np.ceil(chunk_size / nth_frame)) * nth_frame
 
 
     def initalize(self):
@@ -56,7 +101,9 @@ class Vid_To_Img:
         # assert os.path.isfile(self.video), 'given video cannot be found'
 
         # Creating the
-        if os.path.isdir(self.save_folder):
+        # When running non-interactively (i.e. under a batch scheduler) there is nobody to ask, so
+        # an existing folder is simply written into
+        if os.path.isdir(self.save_folder) and self.interactive:
 
             answer = input('Given save_folder exists. Are you sure you want to write images here? (y/n)')
 
@@ -71,7 +118,7 @@ class Vid_To_Img:
                 print('creating given save folder...')
 
         # If the save_folder does not exist, create it
-        else:
+        elif not os.path.isdir(self.save_folder):
 
             print('given save_folder does not exist, creating...')
             os.mkdir(self.save_folder)
@@ -83,25 +130,181 @@ class Vid_To_Img:
         # that each single_proc is responsible for
         # This is *extremely* important in terms of parallelizing the work
 
-        # First, we grab the length of the video...
-        video.set(cv2.CAP_PROP_POS_AVI_RATIO, 1)
-        self.video_len = video.get(cv2.CAP_PROP_POS_MSEC) / 1000 # THIS IS THE LEN IN SECONDS
+        # First, we grab the length of the video, in frames, straight from the container...
+        self.video_len = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
 
-        # Multiplying the number of seconds by the Frames Per Second of the video
-        self.video_len = self.video_len * video.get(cv2.CAP_PROP_FPS)
+        # ...and if the container does not know, fall back to seconds * Frames Per Second
+        if self.video_len <= 0:
+            video.set(cv2.CAP_PROP_POS_AVI_RATIO, 1)
+            self.video_len = int(round(video.get(cv2.CAP_PROP_POS_MSEC) / 1000 * video.get(cv2.CAP_PROP_FPS)))
 
-        beginning = 0
-        for i in range(self.n_parallel):
+        video.release()
 
-            # self.job_dict[str(i)] = (beginning, round(beginning + self.video_len / self.n_parallel))
+        # The segment boundaries are computed from the index of the segment rather than accumulated,
+        # so that rounding can never leave a gap or an overlap between two neighbouring segments.
+        # They are also snapped onto the nth_frame grid for the same reason as the chunks are
+        boundaries = [int(round(i * self.video_len / self.n_parallel / self.nth_frame)) * self.nth_frame
+                      for i in range(self.n_parallel)] + [self.video_len]
 
+        for i in range(self.n_parallel):
 
             self.job_dict[str(i)] = {}
-            self.job_dict[str(i)]['start'] = beginning
-            self.job_dict[str(i)]['end'] = round(beginning + self.video_len / self.n_parallel)
-            self.job_dict[str(i)]['name'] = str(random.getrandbits(16))
+            self.job_dict[str(i)]['start'] = boundaries[i]
+            self.job_dict[str(i)]['end'] = boundaries[i + 1]
+            self.job_dict[str(i)]['name'] = self.video_id + '-' + str(i)
+
+        # The (start, end) chunks used by .managed_parse()
+        self.chunks = [(start, min(start + self.chunk_size, self.video_len))
+                       for start in range(0, self.video_len, self.chunk_size)]
+
+    def _frame_path(self, frame_counter, img_format='png'):
+        """The file that a frame gets saved to. Deterministic, so that re-runs overwrite rather than duplicate
+
+        Args:
+            frame_counter: the number of the frame within the video, int
+            img_format: the image extension, str
+
+        Returns:
+            the full path, str
+        """
+
+        return os.path.join(self.save_folder, f'{self.video_id}_{frame_counter:07d}.{img_format}')
+
+    def _read_manifest(self):
+        """Reads the chunks that a previous run has already finished
+
+        A manifest written with a different nth_frame or chunk_size describes different chunks than the
+        ones that we are about to parse, and one written with different dedup settings kept different
+        frames, so it is ignored (and later overwritten) rather than trusted.
+
+        Returns:
+            a set of the completed (start, end) chunks
+        """
+
+        if not os.path.isfile(self.manifest_file):
+            return set()
+
+        with open(self.manifest_file, 'r') as f:
+            manifest = json.load(f)
+
+        if (manifest['nth_frame'], manifest['chunk_size'], manifest['video_len'],
+                manifest.get('dedup'), manifest.get('dedup_threshold')) != \
+                (self.nth_frame, self.chunk_size, self.video_len, self.dedup, self.dedup_threshold):
+            print(f'{self.manifest_file} was written with different settings, starting from scratch...')
+            return set()
+
+        return set(tuple(chunk) for chunk in manifest['completed'])
+
+    def _write_manifest(self, completed):
+        """Records the finished chunks. Written to a temp file and then swapped in, so that a crash
+        part way through the write can never leave a corrupt manifest behind
+
+        Args:
+            completed: the completed (start, end) chunks, set
+
+        Returns:
+
+        """
+
+        manifest = {'video_file': self.video_file,
+                    'video_len': self.video_len,
+                    'nth_frame': self.nth_frame,
+                    'chunk_size': self.chunk_size,
+                    'dedup': self.dedup,
+                    'dedup_threshold': self.dedup_threshold,
+                    'completed': sorted(completed)}
+
+        with open(self.manifest_file + '.tmp', 'w') as f:
+            f.write(json.dumps(manifest))
+
+        os.replace(self.manifest_file + '.tmp', self.manifest_file)
+
+    def _iter_frames(self, local_vid, start, end):
+        """A generator that walks the [start, end) segment of an open video and yields every nth frame
+
+        In 'sequential' mode we seek exactly once, to the start of the segment, and then walk forward
+        with .grab(). Grabbing only demuxes/decodes the packet, the (expensive) conversion into a BGR
+        np.array only happens in .retrieve(), which we only call for the frames we keep.
+
+        In 'seek' mode we set the frame position before every read. This forces OpenCV to jump back to
+        the nearest keyframe and re-decode up to the requested frame, which is what the original
+        implementation did. It is kept around for benchmarking and for codecs with broken timestamps.
+
+        Args:
+            local_vid: an opened video, cv2.VideoCapture
+            start: the first frame of the segment, int
+            end: the frame at which the segment stops (exclusive), int
+
+        Returns:
+            yields (frame_number, img) tuples, (int, np.array)
+        """
+
+        start = int(start)
+        end = int(end)
+
+        if self.decode_mode == 'seek':
+
+            for frame_counter in range(start, end, self.nth_frame):
+
+                local_vid.set(cv2.CAP_PROP_POS_FRAMES, frame_counter)
+                success, img = local_vid.read()
+
+                # Running past the end of the video is not an error, there is simply nothing left
+                if not success:
+                    return
+
+                yield frame_counter, img
+
+        else:
+
+            # One seek per segment, everything after this is a straight sequential decode
+            local_vid.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+            for frame_counter in range(start, end):
+
+                if not local_vid.grab():
+                    return
 
-            beginning += round(self.video_len / self.n_parallel)
+                # Only pay for the colour conversion/copy on the frames that we keep
+                if (frame_counter - start) % self.nth_frame == 0:
+
+                    success, img = local_vid.retrieve()
+
+                    if not success:
+                        return
+
+                    yield frame_counter, img
+
+    def _iter_kept_frames(self, local_vid, start, end, frame_filter):
+        """Wraps ._iter_frames() with the near-duplicate filter, so dropped frames never reach the encoder
+
+        Args:
+            local_vid: an opened video, cv2.VideoCapture
+            start: the first frame of the segment, int
+            end: the frame at which the segment stops (exclusive), int
+            frame_filter: the filter to apply, None to keep everything, FrameFilter
+
+        Returns:
+            yields (frame_number, img) tuples, (int, np.array)
+        """
+
+        for frame_counter, img in self._iter_frames(local_vid, start, end):
+
+            if frame_filter is None or frame_filter.keep(img):
+                yield frame_counter, img
+
+    def _new_filter(self):
+        """Every worker gets a filter of its own. This means the first frame of every segment/chunk is
+        always kept, as there is nothing to compare it to
+
+        Returns:
+            FrameFilter, or None when dedup is off
+        """
+
+        if self.dedup is None:
+            return None
+
+        return FrameFilter(method=self.dedup, threshold=self.dedup_threshold)
 
     def single_parse(self, start, end, name):
         """
@@ -109,7 +312,7 @@ class Vid_To_Img:
         Args:
             start: the frame in the video where the parsing should start, float
             end: the frame in the video where the parsing should end, float
-            name: the name of the process, used to keep all parallel processes from overwriting eachother
+            name: the name of the process, used when reporting on it
 
         Returns:
 
@@ -121,36 +324,80 @@ class Vid_To_Img:
         # Re-initing the video locally
         local_vid = cv2.VideoCapture(self.video_file)
 
-        # Init a frame counter. This will allow us to keep track of where in the video this
-        # single process should be
-        frame_counter = start
+        # Walking through our section of the video. The generator keeps track of where in the video
+        # this single process should be and stops once it reaches the end of the section
+        frame_filter = self._new_filter()
+        for frame_counter, img in self._iter_kept_frames(local_vid, start, end, frame_filter):
 
-        # As our frame_counter increases, we will know when to stop parsing the video for the given
-        # section by comparing it to the end of the section
-        while frame_counter < end:
+            cv2.imwrite(self._frame_path(frame_counter), img)
 
-            # Setting the current frame in the video
-            local_vid.set(1, frame_counter)
+        # Once outside of the loop we can release the video
+        # This frees up a pointer, deallocates memory, and closes the IO stream to the file
+        local_vid.release()
 
-            # Extracting the video
-            # We use the randomly generated name of the process to stop files from being overwritten
-            success, img = local_vid.read()
+        if frame_filter is not None:
+            print(f'Job {name}: kept {frame_filter.n_kept} frames, dropped {frame_filter.n_dropped} near-duplicates')
 
-            cv2.imwrite(os.path.join(self.save_folder, str(frame_counter) + '_' + name + '.png'),
-                        img)
+    def benchmark(self, nth_frames=(1, 5, 30, 60), n_frames=1800, start=0):
+        """Times the decode engines against each other on a single segment of the video
 
-            # Incrementing the counter
-            frame_counter += self.nth_frame
+        Nothing is written to disk here, we only want to measure how quickly each engine can hand
+        back the frames that would be kept.
 
-        # Once outside of the loop we can release the video
-        # This frees up a pointer, deallocates memory, and closes the IO stream to the file
-        local_vid.release()
+        Args:
+            nth_frames: the nth_frame values to test, iterable of int
+            n_frames: the length of the segment to decode, in frames, int
+            start: the frame at which the segment begins, int
+
+        Returns:
+            {nth_frame: {decode_mode: frames kept per second}}
+        """
+
+        # Remembering the settings of the instance so that we can put them back when we are done
+        original_mode, original_nth = self.decode_mode, self.nth_frame
+
+        results = {}
+
+        try:
+            for nth in nth_frames:
+
+                results[nth] = {}
+                self.nth_frame = nth
+
+                for mode in ['seek', 'sequential']:
+
+                    self.decode_mode = mode
+                    local_vid = cv2.VideoCapture(self.video_file)
+
+                    tic = time.perf_counter()
+                    n_kept = sum(1 for _ in self._iter_frames(local_vid, start, start + n_frames))
+                    elapsed = time.perf_counter() - tic
+
+                    local_vid.release()
+
+                    results[nth][mode] = n_kept / elapsed if elapsed > 0 else float('inf')
+
+                # A segment past the end of the video (or shorter than nth) keeps no frames, so there is no ratio
+                ratio = f'{results[nth]["sequential"] / results[nth]["seek"]:.2f}x' if results[nth]['seek'] > 0 \
+                    else 'no frames kept'
+                print(f'nth_frame={nth}: seek {results[nth]["seek"]:.1f} frames/s, '
+                      f'sequential {results[nth]["sequential"]:.1f} frames/s ({ratio})')
+
+        finally:
+            self.decode_mode, self.nth_frame = original_mode, original_nth
+
+        return results
 
     def parallel_parse(self):
-        """"""
+        """Spawns one .single_parse() process per segment and waits on all of them
+
+        Returns:
+            a list of the keys in job_dict whose process did not exit cleanly
+        """
 
         assert len(self.job_dict) == self.n_parallel, 'please check your .initalization()'
 
+        processes = {}
         for i in range(self.n_parallel):
 
             p = multiprocessing.Process(target=self.single_parse,
@@ -160,8 +407,378 @@ class Vid_To_Img:
 
 
             p.start()
+            processes[str(i)] = p
             print(f'Started job {str(i)}...')
 
+        # Waiting on every job and checking how it went
+        failed = []
+        for job, p in processes.items():
+            p.join()
+
+            if p.exitcode != 0:
+                print(f'Job {job} exited with code {p.exitcode}')
+                failed.append(job)
+
+        return failed
+
+    def _parse_chunk(self, start, end):
+        """Parses a single chunk of the video. This is what the .managed_parse() workers run
+
+        Args:
+            start: the frame in the video where the parsing should start, int
+            end: the frame in the video where the parsing should end, int
+
+        Returns:
+            (the number of frames written, the number of near-duplicates dropped), (int, int)
+        """
+
+        local_vid = cv2.VideoCapture(self.video_file)
+
+        # Raising here (rather than quietly writing nothing) gets the chunk retried
+        if not local_vid.isOpened():
+            raise IOError(f'could not open {self.video_file}')
+
+        n_written = 0
+        frame_filter = self._new_filter()
+        for frame_counter, img in self._iter_kept_frames(local_vid, start, end, frame_filter):
+
+            if not cv2.imwrite(self._frame_path(frame_counter), img):
+                raise IOError(f'could not write frame {frame_counter}')
+
+            n_written += 1
+
+        local_vid.release()
+
+        return n_written, 0 if frame_filter is None else frame_filter.n_dropped
+
+    def managed_parse(self, report_every=5.):
+        """Parses the video with a fixed-size pool of workers pulling chunks off of a shared queue
+
+        Workers take the next chunk as soon as they finish their current one, so fast workers pick up
+        the slack of slow ones. A chunk that raises is resubmitted up to max_retries times. If a worker
+        dies outright (e.g. a segfault inside of the decoder) the pool is rebuilt and every chunk that
+        was still outstanding is resubmitted, which also counts against their retries.
+
+        Every finished chunk is recorded in the manifest straight away. Chunks that the manifest says are
+        already done are skipped, so calling this again after a crash (or on a video that has already
+        been parsed) only does the work that is left.
+
+        Args:
+            report_every: how often to print progress, in seconds, float
+
+        Returns:
+            a list of the (start, end) chunks that still failed after all of their retries
+        """
+
+        assert len(self.chunks) > 0, 'please check your .initalization()'
+
+        completed = self._read_manifest()
+        pending = [chunk for chunk in self.chunks if chunk not in completed]
+
+        if len(pending) < len(self.chunks):
+            print(f'{len(self.chunks) - len(pending)}/{len(self.chunks)} chunks are already done, skipping them...')
+
+        # Chunks start on the nth_frame grid, so each of them holds ceil(length / nth_frame) frames to keep
+        expected = sum(int(np.ceil((end - start) / self.nth_frame)) for start, end in pending)
+        attempts = {chunk: 0 for chunk in pending}
+        failed = []
+        n_written = 0
+        n_dropped = 0
+
+        start = time.perf_counter()
+        last_report = start
+
+        while pending:
+
+            executor = ProcessPoolExecutor(max_workers=self.n_parallel)
+            futures = {executor.submit(self._parse_chunk, *chunk): chunk for chunk in pending}
+            pending = []
+
+            try:
+                while futures:
+
+                    # Waking up at least every report_every seconds so that progress gets printed
+                    # even while a handful of long chunks are the only thing left running
+                    done, _ = wait(futures, timeout=report_every, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+
+                        chunk = futures.pop(future)
+
+                        try:
+                            chunk_written, chunk_dropped = future.result()
+                            n_written += chunk_written
+                            n_dropped += chunk_dropped
+
+                            completed.add(chunk)
+                            self._write_manifest(completed)
+
+                        except BrokenProcessPool:
+                            futures[future] = chunk
+                            raise
+
+                        except Exception as e:
+                            attempts[chunk] += 1
+                            print(f'Chunk {chunk} failed ({e}), attempt {attempts[chunk]}/{self.max_retries + 1}')
+
+                            if attempts[chunk] <= self.max_retries:
+                                futures[executor.submit(self._parse_chunk, *chunk)] = chunk
+                            else:
+                                failed.append(chunk)
+
+                    # Progress report
+                    now = time.perf_counter()
+                    if now - last_report >= report_every:
+                        last_report = now
+                        fps = (n_written + n_dropped) / (now - start)
+                        eta = (expected - n_written - n_dropped) / fps if fps > 0 else float('inf')
+                        print(f'{n_written + n_dropped}/{expected} frames ({n_dropped} dropped) | '
+                              f'{fps:.1f} frames/s | ETA {eta:.0f} seconds')
+
+            except BrokenProcessPool:
+                # Everything that had not come back yet needs to go around again
+                for chunk in futures.values():
+                    attempts[chunk] += 1
+
+                    if attempts[chunk] <= self.max_retries:
+                        pending.append(chunk)
+                    else:
+                        failed.append(chunk)
+
+                print(f'A worker died, restarting the pool with {len(pending)} chunks left to go...')
+
+            finally:
+                executor.shutdown(wait=True)
+
+        total_time = time.perf_counter() - start
+        print(f'Done. Wrote {n_written} frames in {total_time:.1f} seconds '
+              f'({(n_written + n_dropped) / total_time:.1f} frames/s), dropped {n_dropped} near-duplicates, '
+              f'{len(failed)} chunks failed')
+
+        return sorted(failed)
+
+    def _decode_worker(self, start, end, name, slots, slot_shape, free_slots, full_slots, n_decoded, n_dropped):
+        """The producer half of .pipelined_parse(). Decodes a segment of the video into the shared slots
+
+        Args:
+            start: the frame in the video where the parsing should start, float
+            end: the frame in the video where the parsing should end, float
+            name: the name of the process, used when reporting on it
+            slots: the shared frame buffer, multiprocessing.RawArray
+            slot_shape: the (h, w, c) shape of a single frame, tuple
+            free_slots: indices of the slots that are ready to be written into, multiprocessing.Queue
+            full_slots: (slot, frame_number) tuples waiting to be encoded, multiprocessing.Queue
+            n_decoded: a shared counter of the frames decoded (and kept) so far, multiprocessing.Value
+            n_dropped: a shared counter of the near-duplicate frames dropped so far, multiprocessing.Value
+
+        Returns:
+
+        """
+
+        # Viewing the shared memory as n_slots frames. No copy happens here
+        buffer = np.frombuffer(slots, dtype=np.uint8).reshape((-1,) + slot_shape)
+
+        local_vid = cv2.VideoCapture(self.video_file)
+
+        # Duplicates are dropped before they are copied into a slot, they never cost the encoders anything
+        frame_filter = self._new_filter()
+        for frame_counter, img in self._iter_kept_frames(local_vid, start, end, frame_filter):
+
+            # This blocks whenever every slot is in use, which is what keeps memory capped
+            # when the encoders are slower than the decoders
+            slot = free_slots.get()
+            buffer[slot] = img
+            full_slots.put((slot, frame_counter))
+
+            with n_decoded.get_lock():
+                n_decoded.value += 1
+
+        local_vid.release()
+
+        if frame_filter is not None:
+            with n_dropped.get_lock():
+                n_dropped.value += frame_filter.n_dropped
+
+        print(f'Decoder {name} is done')
+
+    def _encode_worker(self, slots, slot_shape, free_slots, full_slots, n_written, img_format):
+        """The consumer half of .pipelined_parse(). Compresses frames out of the shared slots and writes them
+
+        Args:
+            slots: the shared frame buffer, multiprocessing.RawArray
+            slot_shape: the (h, w, c) shape of a single frame, tuple
+            free_slots: indices of the slots that are ready to be written into, multiprocessing.Queue
+            full_slots: (slot, frame_number) tuples waiting to be encoded, multiprocessing.Queue
+            n_written: a shared counter of the frames written so far, multiprocessing.Value
+            img_format: the image extension to write, which also picks the encoder, str
+
+        Returns:
+
+        """
+
+        buffer = np.frombuffer(slots, dtype=np.uint8).reshape((-1,) + slot_shape)
+
+        while True:
+
+            job = full_slots.get()
+
+            # A None is the signal that all of the decoders are done
+            if job is None:
+                break
+
+            slot, frame_counter = job
+
+            written = cv2.imwrite(self._frame_path(frame_counter, img_format), buffer[slot])
+
+            # Handing the slot back to the decoders only once the encoder is finished reading it (even when the
+            # write failed, so that the decoders are never short a slot)
+            free_slots.put(slot)
+
+            # Raising ends the encoder with a non-zero exit code, which .pipelined_parse() reports
+            if not written:
+                raise IOError(f'could not write frame {frame_counter}')
+
+            with n_written.get_lock():
+                n_written.value += 1
+
+    def pipelined_parse(self, n_encoders, queue_size=64, img_format='png', report_every=5.):
+        """Parses the video with the decoding and the image encoding split into separate process pools
+
+        .parallel_parse() runs decode -> imwrite -> decode -> ... in every process, so the decoder
+        sits idle while PNG compression happens. Here the n_parallel decoders push frames into a
+        bounded pool of queue_size shared-memory slots, and n_encoders writers drain it. Frames are
+        never pickled, only slot indices travel through the queues, and memory use is capped at
+        queue_size frames no matter how far ahead the decoders get.
+
+        Args:
+            n_encoders: the number of encoder/writer processes to spawn, int
+            queue_size: the number of frames that can be in flight between the two stages, int
+            img_format: 'png' or 'jpg', str
+            report_every: how often to print queue depth and throughput, in seconds, float
+
+        Returns:
+            a dict of stats: frames decoded/written, frames per second of each stage, and the keys in
+            job_dict whose decoder did not exit cleanly
+        """
+
+        assert len(self.job_dict) == self.n_parallel, 'please check your .initalization()'
+        assert img_format in ['png', 'jpg'], 'img_format must be one of: png, jpg'
+
+        # Every slot needs to hold a single full frame
+        video = cv2.VideoCapture(self.video_file)
+        slot_shape = (int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(video.get(cv2.CAP_PROP_FRAME_WIDTH)), 3)
+        video.release()
+
+        # A RawArray has no lock, which is fine as no two processes ever own the same slot at once. The queues see to that
+        slots = multiprocessing.RawArray('B', queue_size * int(np.prod(slot_shape)))
+
+        free_slots = multiprocessing.Queue()
+        full_slots = multiprocessing.Queue()
+        for slot in range(queue_size):
+            free_slots.put(slot)
+
+        n_decoded = multiprocessing.Value('L', 0)
+        n_written = multiprocessing.Value('L', 0)
+        n_dropped = multiprocessing.Value('L', 0)
+
+        encoders = [multiprocessing.Process(target=self._encode_worker,
+                                            args=(slots, slot_shape, free_slots, full_slots,
+                                                  n_written, img_format, ))
+                    for _ in range(n_encoders)]
+
+        decoders = [multiprocessing.Process(target=self._decode_worker,
+                                            args=(self.job_dict[str(i)]['start'],
+                                                  self.job_dict[str(i)]['end'],
+                                                  self.job_dict[str(i)]['name'],
+                                                  slots, slot_shape, free_slots, full_slots,
+                                                  n_decoded, n_dropped, ))
+                    for i in range(self.n_parallel)]
+
+        start = time.perf_counter()
+
+        for p in encoders + decoders:
+            p.start()
+
+        print(f'Started {len(decoders)} decoders and {len(encoders)} encoders...')
+
+        # Reporting on the pipeline while the decoders are working. Waiting on the sentinels of every process
+        # rather than sleeping means that we move on as soon as the last decoder exits, and that we notice an
+        # encoder dying straight away. Encoders are what hand the slots back, so without them the decoders
+        # would wait on free_slots forever
+        decoding = {p.sentinel for p in decoders}
+        encoding = {p.sentinel for p in encoders}
+        encoder_died = False
+        while decoding:
+
+            for sentinel in multiprocessing.connection.wait(list(decoding | encoding), timeout=report_every):
+                if sentinel in decoding:
+                    decoding.discard(sentinel)
+                else:
+                    encoding.discard(sentinel)
+                    encoder_died = True
+
+            if encoder_died or not decoding:
+                break
+
+            elapsed = time.perf_counter() - start
+            print(f'queue depth: {n_decoded.value - n_written.value}/{queue_size} | '
+                  f'decode: {n_decoded.value / elapsed:.1f} frames/s | '
+                  f'encode: {n_written.value / elapsed:.1f} frames/s')
+
+        decode_time = time.perf_counter() - start
+
+        if encoder_died:
+            print('An encoder died while the decoders were still running, stopping the pipeline...')
+
+            for p in decoders + encoders:
+                if p.is_alive():
+                    p.terminate()
+
+        else:
+            # All of the frames are in the queue by now, one sentinel per encoder tells them to shut down
+            for _ in encoders:
+                full_slots.put(None)
+
+        # Checking how every job went, same as .parallel_parse(). A decoder that crashed leaves its frames missing
+        failed = []
+        for i, p in enumerate(decoders):
+            p.join()
+
+            if p.exitcode != 0:
+                print(f'Decoder {self.job_dict[str(i)]["name"]} exited with code {p.exitcode}')
+                failed.append(str(i))
+
+        encoders_failed = False
+        for p in encoders:
+            p.join()
+
+            if p.exitcode != 0:
+                print(f'An encoder exited with code {p.exitcode}')
+                encoders_failed = True
+
+        # There is no telling whose frames a dead encoder took with it, so every job counts as failed. Whatever is
+        # left in the queues is never going to be read, so the parent must not wait on flushing it at exit either
+        if encoders_failed:
+            failed = sorted(self.job_dict)
+            full_slots.cancel_join_thread()
+            free_slots.cancel_join_thread()
+
+        total_time = time.perf_counter() - start
+
+        stats = {'decoded': n_decoded.value,
+                 'written': n_written.value,
+                 'dropped': n_dropped.value,
+                 'decode_fps': n_decoded.value / decode_time,
+                 'encode_fps': n_written.value / total_time,
+                 'seconds': total_time,
+                 'failed': failed}
+
+        print(f'Done. Wrote {stats["written"]} frames in {total_time:.1f} seconds '
+              f'(decode {stats["decode_fps"]:.1f} frames/s, encode {stats["encode_fps"]:.1f} frames/s), '
+              f'dropped {stats["dropped"]} near-duplicates')
+
+        return stats
+
 
 
 if __name__ == '__main__':
@@ -169,21 +786,61 @@ if __name__ == '__main__':
     # CLI Utils
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('-file', help='the video file to be parsed into frames')
+    parser.add_argument('-file', help='the video file(s) to be parsed into frames', nargs='+')
     parser.add_argument('-n', help='the number of parallel processes to spawn',  type=int)
     parser.add_argument('-nth', help='when skipping frames, take the nth frame', type=int)
     parser.add_argument('-save', help='the folder in which to save the parsed frames')
+    parser.add_argument('-mode', help='the decode engine to use: sequential or seek',
+                        default='sequential', choices=['sequential', 'seek'])
+    parser.add_argument('-bench', help='benchmark the decode engines instead of parsing', action='store_true')
+    parser.add_argument('-managed', help='parse in small chunks with a managed worker pool', action='store_true')
+    parser.add_argument('-chunk', help='the number of frames in a chunk when managed', type=int, default=600)
+    parser.add_argument('-retries', help='how many times to retry a failed chunk when managed', type=int, default=2)
+    parser.add_argument('-dedup', help='drop near-duplicate frames, measured with: dhash or hist',
+                        default=None, choices=['dhash', 'hist'])
+    parser.add_argument('-threshold', help='the difference at or below which a frame is a duplicate', type=float,
+                        default=None)
+    parser.add_argument('-y', help='do not prompt, write into an existing save folder', action='store_true')
+    parser.add_argument('-encoders', help='run pipelined, with this many encoder processes', type=int, default=0)
+    parser.add_argument('-queue', help='the number of frames allowed in flight when pipelined', type=int, default=64)
+    parser.add_argument('-format', help='the image format to write when pipelined', default='png',
+                        choices=['png', 'jpg'])
 
     args = parser.parse_args()
 
-    # After parsing out the args, we can init the class...
-    a = Vid_To_Img(video_file=args.file,
-                   n_parallel=args.n,
-                   nth_frame=args.nth,
-                   save_folder=args.save)
-
-    # Running the initalization of the class
-    a.initalize()
+    # Videos are parsed one after the other. With -managed, videos (and chunks) that a previous run has
+    # already finished are skipped, so new videos can be added to the list and the whole thing re-run
+    failures = []
+    for video_file in args.file:
+
+        # After parsing out the args, we can init the class...
+        a = Vid_To_Img(video_file=video_file,
+                       n_parallel=args.n,
+                       nth_frame=args.nth,
+                       save_folder=args.save,
+                       decode_mode=args.mode,
+                       chunk_size=args.chunk,
+                       max_retries=args.retries,
+                       interactive=not args.y,
+                       dedup=args.dedup,
+                       dedup_threshold=args.threshold)
+
+        # Benchmarking does not touch the save folder, so we can skip the initalization
+        if args.bench:
+            a.benchmark()
+            continue
+
+        # Running the initalization of the class
+        a.initalize()
+
+        # gogogo
+        if args.managed:
+            failures += a.managed_parse()
+        elif args.encoders > 0:
+            failures += a.pipelined_parse(n_encoders=args.encoders, queue_size=args.queue,
+                                          img_format=args.format)['failed']
+        else:
+            failures += a.parallel_parse()
 
-    # gogogo
-    a.parallel_parse()
+    # A non-zero exit code lets a batch scheduler know that some of the video did not get parsed
+    raise SystemExit(1 if failures else 0)
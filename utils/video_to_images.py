@@ -1,13 +1,18 @@
 # Program To Read video
 # and Extract Frames
 import cv2
+from frame_filter import FrameFilter
 
 
 # Function to extract frames
-def FrameCapture(path):
+def FrameCapture(path, dedup=None, threshold=None):
     # Path to video file
     vidObj = cv2.VideoCapture(path)
 
+    # Optionally dropping near-duplicate frames before they are written
+    # dedup is the method used to compare frames: 'dhash' or 'hist' (see frame_filter.py)
+    frame_filter = None if dedup is None else FrameFilter(method=dedup, threshold=threshold)
+
     # Used as counter variable
     count = 0
 
@@ -19,12 +24,20 @@ def FrameCapture(path):
         # function extract frames
         success, image = vidObj.read()
 
+        # Nothing left to read
+        if not success:
+            break
+
         base_path = "E:\\nick\\"
         # Saves the frames with frame-count
-        cv2.imwrite(f"{base_path}frame{count}.jpg", image)
+        if frame_filter is None or frame_filter.keep(image):
+            cv2.imwrite(f"{base_path}frame{count}.jpg", image)
 
         count += 1
 
+    if frame_filter is not None:
+        print(f'Kept {frame_filter.n_kept} frames, dropped {frame_filter.n_dropped} near-duplicates')
+
 
 # Driver Code
 if __name__ == '__main__':